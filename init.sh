@@ -22,3 +22,7 @@ pip install numpy
 pip install cython
 pip install numexpr
 pip install tables==2.3.1
+
+# optional: used to find the dataset offsets (list -c, memory-mapped reads
+# and -readahead). 2.10.0 is the last release for Python 2.
+pip install h5py==2.10.0
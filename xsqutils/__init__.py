@@ -2,10 +2,69 @@ import sys
 import collections
 import re
 
+import numpy
 import tables
 
+try:
+    import h5py
+except:
+    h5py = None
+
 Tag = collections.namedtuple('Tag', 'tag is_colorspace prefix')
 
+# library_descs    - library name -> description (from LibraryDetails)
+# sample_libraries - sample -> library name
+# library_samples  - library name -> samples (in sample order)
+# desc_samples     - description -> samples (in sample order)
+SampleIndex = collections.namedtuple('SampleIndex', 'library_descs sample_libraries library_samples desc_samples')
+
+QV_WILDCARD = 63
+
+# number of reads to read from a region at a time
+DEFAULT_CHUNK_SIZE = 65536
+
+# number of reads that share a random state when subsampling a region
+SAMPLE_BLOCK_SIZE = 65536
+
+# the HDF5 default chunk cache size (per dataset)
+DEFAULT_CHUNK_CACHE_SIZE = 1024 * 1024
+
+# size of the reads used to read ahead in a file
+READAHEAD_BLOCK_SIZE = 1024 * 1024
+
+
+def _call_table(bases, wildcard):
+    codes = numpy.arange(256, dtype=numpy.uint8)
+    table = numpy.array([ord(b) for b in bases], dtype=numpy.uint8)[codes & 0x03]
+    table[(codes >> 2) == QV_WILDCARD] = ord(wildcard)
+    return table
+
+
+def _qual_table():
+    quals = numpy.arange(256, dtype=numpy.uint8) >> 2
+    quals[quals == QV_WILDCARD] = 0
+    return quals + 33
+
+
+# byte -> ASCII call, keyed by is_colorspace
+_CALL_TABLES = {False: _call_table('ACGT', 'N'), True: _call_table('0123', '.')}
+
+# byte -> Phred+33 quality (wildcards get a quality of 0)
+_QUAL_TABLE = _qual_table()
+
+
+def decode_callqv(basequals, is_colorspace=False):
+    '''
+    Decodes a 2-D array of BaseCallQV/ColorCallQV bytes (one row per read).
+    The lower two bits of each byte are the call and the upper six bits are
+    the QV, with a QV of 63 marking a wildcard call (N or .).
+
+    Returns a tuple of uint8 arrays (calls, quals) with the same shape as the
+    input, holding the ASCII calls and the Phred+33 qualities.
+    '''
+    basequals = numpy.asarray(basequals, dtype=numpy.uint8)
+    return _CALL_TABLES[bool(is_colorspace)].take(basequals), _QUAL_TABLE.take(basequals)
+
 
 def natural_sort(ar):
     to_sort = []
@@ -49,11 +108,48 @@ def node_attr_iter(node):
         yield (k, get_node_attr(node, k))
 
 
+def readahead(fname, extents, block_size=READAHEAD_BLOCK_SIZE):
+    '''
+    Reads the (offset, size) byte ranges in extents from a file (and throws
+    the data away), so that they are in the OS page cache when they are read
+    through HDF5. This is meant to be run in a background thread.
+    '''
+    f = open(fname, 'rb')
+    try:
+        for offset, size in extents:
+            f.seek(offset)
+            while size > 0:
+                data = f.read(min(size, block_size))
+                if not data:
+                    break
+                size -= len(data)
+    finally:
+        f.close()
+
+
 class XSQFile(object):
-    def __init__(self, fname):
+    def __init__(self, fname, chunk_cache_size=None, use_mmap=True):
+        '''
+        chunk_cache_size sets the size of the HDF5 chunk cache for each
+        dataset (see chunk_cache_size()), otherwise the HDF5 default is used.
+
+        If use_mmap is set (and h5py is available), contiguous datasets are
+        read through a memory map instead of through HDF5 (see _get_array).
+        '''
         self.fname = fname
-        self.hdf = tables.openFile(fname, 'r')
+
+        kwargs = {}
+        if chunk_cache_size:
+            kwargs['CHUNK_CACHE_SIZE'] = chunk_cache_size
+        self.hdf = tables.openFile(fname, 'r', **kwargs)
+
+        self._h5 = None
+        self._use_mmap = use_mmap
+        self._region_key = None
+        self._region_arrays = None
         self._samples = []
+        self._sample_index = None
+        self._region_counts = {}
 
         for sample, node in node_children_iter(self.hdf.root):
             if sample not in  ['RunMetadata', 'Indexing']:
@@ -66,94 +162,489 @@ class XSQFile(object):
             self.tags[tag] = Tag(tag, get_node_attr(node, 'IsColorPresent') == 1, get_node_attr(node, 'TagSequence'))
 
     def close(self):
+        self._release_region_arrays()
         self.hdf.close()
+        if self._h5:
+            self._h5.close()
+            self._h5 = None
+
+    def _get_h5(self):
+        '''
+        Returns the file opened with h5py (for the dataset offsets), or None
+        if h5py isn't available.
+        '''
+        if self._h5 is None and h5py:
+            self._h5 = h5py.File(self.fname, 'r')
+        return self._h5
+
+    def _region_datasets(self, sample, region_name, tags=None):
+        '''
+        Returns the paths of a region's datasets (yxLocation and the
+        call/QV array for each tag)
+        '''
+        if not tags:
+            tags = self.tags
+
+        paths = ['/%s/%s/Fragments/yxLocation' % (sample, region_name)]
+        for tag in tags:
+            if self.tags[tag].is_colorspace:
+                paths.append('/%s/%s/%s/ColorCallQV' % (sample, region_name, tag))
+            else:
+                paths.append('/%s/%s/%s/BaseCallQV' % (sample, region_name, tag))
+        return paths
+
+    def _first_region(self, sample):
+        '''
+        Returns the name of the first region of a sample (or None), without
+        loading the region nodes (see _get_region_counts)
+        '''
+        if sample in self._region_counts:
+            regions = self._region_counts[sample].keys()
+        else:
+            regions = sorted(self.hdf.root._f_getChild(sample)._v_children.keys())
+
+        if not regions:
+            return None
+        return regions[0]
+
+    def chunk_cache_size(self, rows=DEFAULT_CHUNK_SIZE, samples=None):
+        '''
+        Returns a chunk cache size that holds all of the HDF5 chunks that a
+        read of rows reads (from any offset) touches, for the largest
+        chunked dataset of samples (all of the samples by default). This is
+        so that chunks that are split between two reads (or reads of
+        scattered rows when subsampling) are only read and decompressed
+        once. Only the first region of each sample is used for the dataset
+        chunking.
+
+        Returns None if the datasets aren't chunked (or the default cache is
+        big enough).
+        '''
+        if samples is None:
+            samples = self._samples
+
+        size = 0
+        for sample in samples:
+            region = self._first_region(sample)
+            if region is None:
+                continue
+
+            for path in self._region_datasets(sample, region):
+                node = self.hdf.getNode(path)
+                if not node.chunkshape:
+                    continue
+
+                chunk_bytes = node.atom.itemsize
+                for dim in node.chunkshape:
+                    chunk_bytes *= dim
+
+                # chunks across the row, times the chunks down the rows
+                across = 1
+                for dim, chunkdim in zip(node.shape[1:], node.chunkshape[1:]):
+                    across *= (dim + chunkdim - 1) // chunkdim
+                down = (rows + node.chunkshape[0] - 1) // node.chunkshape[0] + 1
+
+                size = max(size, chunk_bytes * across * down)
+
+        if size <= DEFAULT_CHUNK_CACHE_SIZE:
+            return None
+        return size
+
+    def region_extents(self, sample, region_name, tags=None, start=0, stop=None):
+        '''
+        Returns a list of the (offset, size) byte ranges in the file that hold
+        the reads [start, stop) of a region (for read-ahead). This needs h5py
+        to find the dataset offsets. Chunked datasets also need h5py/HDF5
+        support for chunk info (HDF5 1.10.5 or better), and are skipped if it
+        isn't available. Returns None if h5py isn't available.
+        '''
+        h5 = self._get_h5()
+        if not h5:
+            return None
+
+        if stop is None:
+            stop = self.get_region_read_count(sample, region_name)
+
+        extents = []
+        for path in self._region_datasets(sample, region_name, tags):
+            dset = h5[path]
+            if not len(dset.shape) or start >= stop:
+                continue
+
+            row_bytes = dset.dtype.itemsize
+            for dim in dset.shape[1:]:
+                row_bytes *= dim
+
+            if dset.chunks is None:
+                offset = dset.id.get_offset()
+                if offset is not None:
+                    extents.append((offset + start * row_bytes, (stop - start) * row_bytes))
+                continue
+
+            if not hasattr(dset.id, 'get_chunk_info_by_coord'):
+                continue
+
+            chunk_rows = dset.chunks[0]
+            for row in xrange(start // chunk_rows * chunk_rows, stop, chunk_rows):
+                for col in xrange(0, dset.shape[1], dset.chunks[1]):
+                    info = dset.id.get_chunk_info_by_coord((row, col))
+                    if info.byte_offset is not None:
+                        extents.append((info.byte_offset, info.size))
+
+        return extents
 
     def get_samples(self):
         return self._samples
 
+    def _get_sample_index(self):
+        '''
+        Returns the SampleIndex for the file, built from
+        RunMetadata.LibraryDetails the first time it is needed.
+
+        Barcoded samples are named after their library (Lib1_01, Lib1_02,
+        ...), so each sample is matched to the longest library name that it
+        starts with (followed by '_'). Samples that don't match any library
+        use the part of their name before the first '_'.
+        '''
+        if self._sample_index is None:
+            libraries = self.hdf.root.RunMetadata.LibraryDetails
+
+            descidx = -1
+            for i, name in enumerate(libraries.colnames):
+                if name == 'Description':
+                    descidx = i
+
+            library_descs = {}
+            nametype = libraries.coltypes['LibraryName']
+            if descidx != -1:
+                desctype = libraries.coltypes['Description']
+            for cols in libraries.cols:
+                name = convert_val(cols[0], nametype)
+                if name not in library_descs:
+                    if descidx != -1:
+                        library_descs[name] = convert_val(cols[descidx], desctype)
+                    else:
+                        library_descs[name] = None
+
+            # longest names first, so that Lib1_A is matched before Lib1
+            names = sorted(library_descs, key=len, reverse=True)
+
+            sample_libraries = {}
+            library_samples = collections.OrderedDict()
+            desc_samples = collections.OrderedDict()
+            for sample in self._samples:
+                library = sample.split('_')[0]
+                for name in names:
+                    if sample == name or sample.startswith('%s_' % name):
+                        library = name
+                        break
+
+                sample_libraries[sample] = library
+                library_samples.setdefault(library, []).append(sample)
+
+                desc = library_descs.get(library)
+                if desc:
+                    desc_samples.setdefault(desc.strip(), []).append(sample)
+
+            self._sample_index = SampleIndex(library_descs, sample_libraries, library_samples, desc_samples)
+
+        return self._sample_index
+
+    def _get_region_counts(self, sample):
+        '''
+        Returns an OrderedDict of region name -> read count for a sample
+        (sorted by region name). This is read from the file the first time it
+        is needed for each sample.
+        '''
+        if sample not in self._region_counts:
+            counts = collections.OrderedDict()
+            sample_node = self.hdf.root._f_getChild(sample)
+            for rn in sorted(sample_node._v_children.keys()):
+                region = sample_node._f_getChild(rn)
+                counts[rn] = region._f_getChild('Fragments')._f_getChild('yxLocation').shape[0]
+            self._region_counts[sample] = counts
+
+        return self._region_counts[sample]
+
+    def _load_region_counts(self):
+        '''
+        Reads the region read counts for every sample in one pass, using h5py's
+        low-level object visitation so that no PyTables nodes need to be
+        created. Returns False if h5py isn't available.
+        '''
+        if not h5py:
+            return False
+
+        samples = set(self._samples)
+        counts = {}
+
+        h5 = h5py.File(self.fname, 'r')
+
+        def visit(name):
+            spl = name.split('/')
+            if len(spl) == 4 and spl[0] in samples and spl[2] == 'Fragments' and spl[3] == 'yxLocation':
+                if spl[0] not in counts:
+                    counts[spl[0]] = {}
+                counts[spl[0]][spl[1]] = h5py.h5d.open(h5.id, name).shape[0]
+
+        try:
+            h5py.h5o.visit(h5.id, visit)
+        finally:
+            h5.close()
+
+        for sample in self._samples:
+            sample_counts = counts.get(sample, {})
+            self._region_counts[sample] = collections.OrderedDict([(rn, sample_counts[rn]) for rn in sorted(sample_counts)])
+
+        return True
+
+    def get_read_counts(self):
+        '''
+        Returns an OrderedDict of sample -> read count for all samples.
+        '''
+        if len(self._region_counts) < len(self._samples):
+            self._load_region_counts()
+
+        counts = collections.OrderedDict()
+        for sample in self._samples:
+            counts[sample] = self.get_read_count(sample)
+        return counts
+
     def get_sample_desc(self, sample):
         if sample not in self._samples:
             return None
 
-        descidx = -1
-        for i, name in enumerate(self.hdf.root.RunMetadata.LibraryDetails.colnames):
-            if name == 'Description':
-                descidx = i
-
-        if descidx == -1:
-            return None
-
-        desctype = self.hdf.root.RunMetadata.LibraryDetails.coltypes['Description']
-
-        spl = sample.split('_')
-        for cols in self.hdf.root.RunMetadata.LibraryDetails.cols:
-            if convert_val(cols[0], self.hdf.root.RunMetadata.LibraryDetails.coltypes['LibraryName']) == spl[0]:
-                return convert_val(cols[descidx], desctype)
+        index = self._get_sample_index()
+        return index.library_descs.get(index.sample_libraries[sample])
+
+    def get_sample_library(self, sample):
+        '''
+        Returns the name of the library that sample belongs to (or None if
+        there is no such sample).
+        '''
+        return self._get_sample_index().sample_libraries.get(sample)
+
+    def get_libraries(self):
+        '''
+        Returns the names of the libraries that have samples in the file.
+        '''
+        return self._get_sample_index().library_samples.keys()
+
+    def get_library_samples(self, library):
+        '''
+        Returns the samples that belong to library (a library name or
+        description), or an empty list if there are none.
+        '''
+        index = self._get_sample_index()
+        if library in index.library_samples:
+            return list(index.library_samples[library])
+        return list(index.desc_samples.get(library, []))
 
     def get_read_count(self, sample):
         if not sample in self._samples:
             raise "Invalid sample name: %s" % sample
-        count = 0
 
-        for rn in self.hdf.root._f_getChild(sample)._v_children:
-            region = self.hdf.root._f_getChild(sample)._f_getChild(rn)
-            count += region._f_getChild('Fragments')._f_getChild('yxLocation').shape[0]
-        return count
+        return sum(self._get_region_counts(sample).values())
 
-    def get_regions(self, sample):
-        ar = self.hdf.root._f_getChild(sample)._v_children.keys()
-        ar.sort()
-        return ar
+    def get_region_read_count(self, sample, region_name):
+        return self._get_region_counts(sample)[region_name]
 
-    def fetch_region(self, sample, region_name, tags=None):
-        region_name_int = int(region_name)
-        region = self.hdf.root._f_getChild(sample)._f_getChild(region_name)
+    def get_regions(self, sample):
+        return self._get_region_counts(sample).keys()
+
+    def _get_array(self, path):
+        '''
+        Returns a dataset as a read-only numpy.memmap of the file if it is
+        stored contiguously (no chunking or compression, and h5py is
+        available to find its offset), or as the PyTables node otherwise.
+        Either one can be sliced to read rows, but slices of the memmap are
+        views of the OS page cache instead of copies read through HDF5.
+        '''
+        h5 = None
+        if self._use_mmap:
+            h5 = self._get_h5()
+
+        if h5:
+            dset = h5[path]
+            nbytes = dset.dtype.itemsize
+            for dim in dset.shape:
+                nbytes *= dim
+
+            if dset.chunks is None and nbytes and dset.id.get_storage_size() == nbytes:
+                offset = dset.id.get_offset()
+                if offset is not None:
+                    return numpy.memmap(self.fname, dtype=dset.dtype, mode='r', offset=offset, shape=dset.shape)
+
+        return self.hdf.getNode(path)
+
+    def _release_region_arrays(self):
+        '''
+        Drops the arrays for the current region. PyTables nodes are closed
+        (freeing their chunk caches), and each memmap is unmapped (closing
+        its file descriptor) once the last slice of it is gone.
+        '''
+        if self._region_arrays:
+            yxlocation, callqvs = self._region_arrays
+            for arr in [yxlocation] + callqvs.values():
+                if isinstance(arr, tables.Node):
+                    arr._f_close()
+
+        self._region_key = None
+        self._region_arrays = None
+
+    def _get_region_arrays(self, sample, region_name, tags):
+        '''
+        Returns the yxLocation array and a dict of tag -> call/QV array for a
+        region (see _get_array).
+
+        Only the arrays for the last region read are kept open, so that a
+        worker that reads every region of a file (one chunk at a time) has
+        the same number of open files and chunk caches for a file with
+        thousands of regions as for one with a few.
+        '''
+        key = (sample, region_name, tuple(tags))
+        if key != self._region_key:
+            self._release_region_arrays()
+
+            paths = self._region_datasets(sample, region_name, tags)
+            arrays = [self._get_array(path) for path in paths]
+            self._region_key = key
+            self._region_arrays = (arrays[0], dict(zip(tags, arrays[1:])))
+
+        return self._region_arrays
+
+    def fetch_region_arrays(self, sample, region_name, tags=None, start=0, stop=None, raw=False):
+        '''
+        Reads the reads [start, stop) of a region (all of them by default) as
+        NumPy arrays.
+
+        Returns a tuple (locations, values), where locations is an (n, 2) array
+        of y/x positions and values is a dict of tag -> (calls, quals) as
+        returned by decode_callqv (ASCII calls and Phred+33 qualities, one row
+        per read). If raw is True, values is instead a dict of tag -> the
+        undecoded BaseCallQV/ColorCallQV array.
+        '''
         if not tags:
-            tags = self.tags
+            tags = self.tags.keys()
 
-        locations = []
-        for y, x in region._f_getChild('Fragments')._f_getChild('yxLocation'):
-            locations.append((y, x))
+        if stop is None:
+            stop = self.get_region_read_count(sample, region_name)
 
-        vals = {}
+        yxlocation, callqvs = self._get_region_arrays(sample, region_name, tags)
+
+        values = {}
         for tag in tags:
-            vals[tag] = []
-            if self.tags[tag].is_colorspace:
-                k = 'ColorCallQV'
-                bases = '0123'
-                wildcard = '.'
+            basequals = numpy.asarray(callqvs[tag][start:stop])
+            if raw:
+                values[tag] = basequals
             else:
-                k = 'BaseCallQV'
-                bases = 'ACGT'
-                wildcard = 'N'
-
-            for (y, x), basequals in zip(locations, region._f_getChild(tag)._f_getChild(k)[:]):
-                name = '%s_%s_%s' % (region_name_int, y, x)
-                if len(tags) > 1:
-                    name = name + ' %s' % (tag)
-
-                calls = []
-                if self.tags[tag].prefix:
-                    calls.append(self.tags[tag].prefix)
-
-                quals = []
-                for byte in basequals:
-                    call = bases[byte & 0x03]
-                    qual = byte >> 2
+                values[tag] = decode_callqv(basequals, self.tags[tag].is_colorspace)
+
+        return numpy.asarray(yxlocation[start:stop]), values
+
+    def fetch_region_chunks(self, sample, region_name, tags=None, chunk_size=DEFAULT_CHUNK_SIZE, start=0, stop=None, raw=False):
+        '''
+        Reads a region in slices of at most chunk_size reads, so that memory
+        use doesn't depend on the size of the region. Only the reads in
+        [start, stop) are read if given.
+
+        Yields a tuple (locations, values) for each slice, as returned by
+        fetch_region_arrays.
+        '''
+        count = self.get_region_read_count(sample, region_name)
+        if stop is None or stop > count:
+            stop = count
+
+        for chunk_start in xrange(start, stop, chunk_size):
+            yield self.fetch_region_arrays(sample, region_name, tags, chunk_start, min(chunk_start + chunk_size, stop), raw)
+
+    def fetch_region_rows(self, sample, region_name, rows, tags=None, raw=False):
+        '''
+        Reads only the given reads of a region. rows is a sorted array of read
+        indexes, which are read from the file with a (fancy) point selection
+        instead of reading the whole region.
+
+        Returns a tuple (locations, values), as fetch_region_arrays does.
+        '''
+        if not tags:
+            tags = self.tags.keys()
 
-                    if qual == 63:
-                        call = wildcard
-                        qual = 0
+        if len(rows) == 0:
+            return self.fetch_region_arrays(sample, region_name, tags, 0, 0, raw)
 
-                    calls.append(call)
-                    quals.append(qual)
+        yxlocation, callqvs = self._get_region_arrays(sample, region_name, tags)
+        rows = numpy.asarray(rows).tolist()
 
-                vals[tag].append((name, ''.join(calls), quals))
-                #yield (name, ''.join(calls), quals)
+        values = {}
+        for tag in tags:
+            basequals = numpy.asarray(callqvs[tag][rows, :])
+            if raw:
+                values[tag] = basequals
+            else:
+                values[tag] = decode_callqv(basequals, self.tags[tag].is_colorspace)
+
+        return numpy.asarray(yxlocation[rows, :]), values
+
+    def sample_region_rows(self, sample, region_name, fraction, seed=0, start=0, stop=None):
+        '''
+        Picks a random subsample (about fraction of the reads) of the reads in
+        [start, stop) of a region. The same reads are picked for a given seed
+        however the region is split up, as each block of SAMPLE_BLOCK_SIZE
+        reads has its own random state.
+
+        Returns a sorted array of read indexes.
+        '''
+        count = self.get_region_read_count(sample, region_name)
+        if stop is None or stop > count:
+            stop = count
+
+        rows = []
+        for block in xrange(start // SAMPLE_BLOCK_SIZE, (stop + SAMPLE_BLOCK_SIZE - 1) // SAMPLE_BLOCK_SIZE):
+            block_start = block * SAMPLE_BLOCK_SIZE
+            rand = numpy.random.RandomState([seed, int(region_name), block]).random_sample(SAMPLE_BLOCK_SIZE)
+            picked = numpy.flatnonzero(rand < fraction) + block_start
+            rows.append(picked[(picked >= start) & (picked < stop)])
+
+        if not rows:
+            return numpy.array([], dtype=numpy.int64)
+        return numpy.concatenate(rows)
+
+    def fetch_region_sample(self, sample, region_name, fraction, seed=0, tags=None, chunk_size=DEFAULT_CHUNK_SIZE, start=0, stop=None, raw=False):
+        '''
+        Reads a random subsample of the reads in [start, stop) of a region
+        (see sample_region_rows), reading only the picked reads from the file.
+
+        Yields a tuple (locations, values) for each slice of at most
+        chunk_size picked reads, as fetch_region_chunks does.
+        '''
+        rows = self.sample_region_rows(sample, region_name, fraction, seed, start, stop)
+        for i in xrange(0, len(rows), chunk_size):
+            yield self.fetch_region_rows(sample, region_name, rows[i:i + chunk_size], tags, raw)
+
+    def fetch_region(self, sample, region_name, tags=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        region_name_int = int(region_name)
+        if not tags:
+            tags = self.tags
 
-        for i in xrange(len(locations)):
+        for locations, decoded in self.fetch_region_chunks(sample, region_name, tags, chunk_size):
+            vals = []
             for tag in tags:
-                yield(vals[tag][i])
+                calls, quals = decoded[tag]
+                quals = quals - 33
+                prefix = self.tags[tag].prefix
+
+                tagvals = []
+                for (y, x), read_calls, read_quals in zip(locations, calls, quals):
+                    name = '%s_%s_%s' % (region_name_int, y, x)
+                    if len(tags) > 1:
+                        name = name + ' %s' % (tag)
+
+                    tagvals.append((name, prefix + read_calls.tostring(), read_quals.tolist()))
+                vals.append(tagvals)
+
+            for reads in zip(*vals):
+                for read in reads:
+                    yield read
 
     def dump_table(self, node, indent=0):
         spaces = '  ' * indent
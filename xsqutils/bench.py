@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+'''
+Benchmarks the conversion pipeline on a synthetic XSQ file.
+
+The synthetic file has the same layout as a real XSQ file (as far as
+XSQFile is concerned): RunMetadata/TagDetails, RunMetadata/LibraryDetails and
+/sample/region/Fragments/yxLocation with a BaseCallQV or ColorCallQV array
+for each tag.
+
+The file is converted the same way as xsq convert (with -stats), once for
+each -procs value, and the time spent in each stage (see stats.ConvertStats)
+is reported.
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+
+import numpy
+import tables
+
+from xsqutils import XSQFile, DEFAULT_CHUNK_SIZE
+from xsqutils.compress import DEFAULT_LEVEL
+from xsqutils.jobs import ConvertOptions
+from xsqutils.xsq import _convert_samples, _compression
+
+# tag, is_colorspace, prefix, read length
+DEFAULT_TAGS = [('F3', True, 'T', 50), ('R5', False, '', 35)]
+
+
+class _LibraryDetails(tables.IsDescription):
+    LibraryName = tables.StringCol(255, pos=0)
+    Description = tables.StringCol(255, pos=1)
+
+
+def make_xsq(fname, samples=2, regions=4, reads=100000, tags=DEFAULT_TAGS, wildcards=0.05, chunked=False, seed=0):
+    '''
+    Writes a synthetic XSQ file with samples (Lib1_01, Lib2_01, ...) of
+    regions regions each, and reads reads in each region. tags is a list of
+    (tag, is_colorspace, prefix, read length) tuples. Calls and QVs are
+    random, with about wildcards of the calls set to a wildcard.
+
+    If chunked is set, the arrays are written as chunked and compressed
+    datasets (as the instrument writes them), otherwise they are contiguous.
+    '''
+    rand = numpy.random.RandomState(seed)
+    hdf = tables.openFile(fname, 'w', PYTABLES_SYS_ATTRS=False)
+
+    metadata = hdf.createGroup('/', 'RunMetadata')
+    details = hdf.createGroup(metadata, 'TagDetails')
+    for tag, is_colorspace, prefix, length in tags:
+        node = hdf.createGroup(details, tag)
+        node._v_attrs.IsColorPresent = numpy.array([is_colorspace], dtype=numpy.uint8)
+        node._v_attrs.TagSequence = numpy.array([prefix], dtype='|S255')
+
+    names = ['Lib%s_01' % (i + 1) for i in xrange(samples)]
+
+    libraries = hdf.createTable(metadata, 'LibraryDetails', _LibraryDetails)
+    for name in names:
+        row = libraries.row
+        row['LibraryName'] = name.split('_')[0]
+        row['Description'] = 'Synthetic library %s' % name.split('_')[0]
+        row.append()
+    libraries.flush()
+
+    hdf.createGroup('/', 'Indexing')
+
+    filters = None
+    if chunked:
+        filters = tables.Filters(complevel=1, complib='zlib', shuffle=False)
+
+    def write_array(group, name, data):
+        if chunked:
+            array = hdf.createCArray(group, name, tables.Atom.from_dtype(data.dtype), data.shape, filters=filters)
+            array[:] = data
+        else:
+            hdf.createArray(group, name, data)
+
+    for name in names:
+        sample = hdf.createGroup('/', name)
+        for i in xrange(regions):
+            region = hdf.createGroup(sample, '%04d' % (i + 1))
+            fragments = hdf.createGroup(region, 'Fragments')
+            write_array(fragments, 'yxLocation', rand.randint(0, 4096, size=(reads, 2)).astype(numpy.uint16))
+
+            for tag, is_colorspace, prefix, length in tags:
+                callqv = rand.randint(0, 256, size=(reads, length)).astype(numpy.uint8)
+                wild = rand.random_sample((reads, length)) < wildcards
+                callqv[wild] = 0xfc | rand.randint(0, 4, size=wild.sum())
+
+                node = hdf.createGroup(region, tag)
+                if is_colorspace:
+                    write_array(node, 'ColorCallQV', callqv)
+                else:
+                    write_array(node, 'BaseCallQV', callqv)
+
+    hdf.close()
+
+
+def bench_convert(filename, options, procs=1, tmpdir=None):
+    '''
+    Converts all of the samples in filename (to a temporary directory) and
+    returns the ConvertStats for the conversion.
+    '''
+    tmpdir = tempfile.mkdtemp(prefix='xsqbench.', dir=tmpdir)
+    try:
+        xsq = XSQFile(filename)
+        samples = [(filename, sample, [os.path.join(tmpdir, '%s.out' % sample)], options) for sample in xsq.get_samples()]
+        xsq.close()
+
+        return _convert_samples(samples, procs, tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench(filename, procs_list, options, out=sys.stdout):
+    for procs in procs_list:
+        out.write('[-procs %s]\n' % procs)
+        bench_convert(filename, options, procs).write_summary(out)
+        out.write('\n')
+        out.flush()
+
+
+def _parse_tags(val):
+    '''
+    Parses tags given as tag:length[:cs], for example F3:50:cs,R5:35
+    '''
+    tags = []
+    for spec in val.split(','):
+        spl = spec.split(':')
+        is_colorspace = len(spl) > 2 and spl[2] == 'cs'
+        tags.append((spl[0], is_colorspace, 'T' if is_colorspace else '', int(spl[1])))
+    return tags
+
+
+def usage():
+    print '''Usage: bench.py {opts}
+
+Writes a synthetic XSQ file and times the read, decode, format, compress and
+merge stages of converting it (reads/sec and MB/sec for each stage).
+
+Options:
+    -samples {val}  Number of samples (default 2)
+    -regions {val}  Number of regions per sample (default 4)
+    -reads {val}    Number of reads per region (default 100000)
+    -tags {val}     Tags to write as tag:length[:cs],... (default F3:50:cs,R5:35)
+    -chunked        Write chunked/compressed datasets (default contiguous)
+    -procs {val}    Comma separated list of -procs values to time
+                    (default 1,2,4)
+    -chunk {val}    Reads per job (default %s)
+    -format {val}   Output format, fastq or bam (default fastq)
+    -noz            Don't compress the output
+    -bgzf           Compress the output as BGZF
+    -level {val}    Compression level (0-9, default %s)
+    -xsq {fname}    Use (or keep) this XSQ file instead of a temporary one
+''' % (DEFAULT_CHUNK_SIZE, DEFAULT_LEVEL)
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    samples = 2
+    regions = 4
+    reads = 100000
+    tags = DEFAULT_TAGS
+    chunked = False
+    procs_list = [1, 2, 4]
+    chunk_size = DEFAULT_CHUNK_SIZE
+    fmt = 'fastq'
+    noz = False
+    bgzf = False
+    level = DEFAULT_LEVEL
+    fname = None
+    last = None
+
+    for arg in sys.argv[1:]:
+        if last == '-samples':
+            samples = int(arg)
+            last = None
+        elif last == '-regions':
+            regions = int(arg)
+            last = None
+        elif last == '-reads':
+            reads = int(arg)
+            last = None
+        elif last == '-tags':
+            tags = _parse_tags(arg)
+            last = None
+        elif last == '-procs':
+            procs_list = [int(x) for x in arg.split(',')]
+            last = None
+        elif last == '-chunk':
+            chunk_size = int(arg)
+            last = None
+        elif last == '-format':
+            fmt = arg
+            last = None
+        elif last == '-level':
+            level = int(arg)
+            if level < 0 or level > 9:
+                sys.stderr.write('Invalid compression level: %s (must be 0-9)\n\n' % arg)
+                usage()
+            last = None
+        elif last == '-xsq':
+            fname = arg
+            last = None
+        elif arg in ['-samples', '-regions', '-reads', '-tags', '-procs', '-chunk', '-format', '-level', '-xsq']:
+            last = arg
+        elif arg == '-chunked':
+            chunked = True
+        elif arg == '-noz':
+            noz = True
+        elif arg == '-bgzf':
+            bgzf = True
+        else:
+            sys.stderr.write('Unknown argument: %s\n\n' % arg)
+            usage()
+
+    if fmt not in ['fastq', 'bam']:
+        sys.stderr.write('Unknown output format: %s\n\n' % fmt)
+        usage()
+
+    tmpdir = None
+    if not fname:
+        tmpdir = tempfile.mkdtemp(prefix='xsqbench.')
+        fname = os.path.join(tmpdir, 'bench.xsq')
+
+    try:
+        if not os.path.exists(fname):
+            sys.stderr.write('Writing %s (%s samples x %s regions x %s reads)\n' % (fname, samples, regions, reads))
+            make_xsq(fname, samples, regions, reads, tags, chunked=chunked)
+
+        options = ConvertOptions(fmt=fmt, compress=_compression(None, noz, bgzf, fmt), level=level, chunk_size=chunk_size, stats=True)
+        bench(fname, procs_list, options)
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,67 @@
+'''
+Compresses blocks of output text as stand-alone gzip members or BGZF blocks.
+
+Each block is compressed on its own, so blocks can be compressed in parallel
+(in the worker processes) and then written out one after the other. A series
+of gzip members is still a valid gzip file, and a series of BGZF blocks
+followed by BGZF_EOF is a valid BGZF file (which can be indexed with
+bgzip/htslib).
+'''
+import struct
+import zlib
+
+DEFAULT_LEVEL = 9
+
+# the maximum amount of data in one BGZF block (same as htslib)
+BGZF_BLOCK_SIZE = 0xff00
+
+# BGZF blocks may not be larger than 64KB (compressed)
+_BGZF_MAX_BLOCK = 0x10000
+
+_BGZF_HEADER = struct.Struct('<BBBBIBBHBBHH')
+_BGZF_FOOTER = struct.Struct('<II')
+
+BGZF_EOF = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+
+def gzip_member(data, level=DEFAULT_LEVEL):
+    comp = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return comp.compress(data) + comp.flush()
+
+
+def _deflate(data, level):
+    comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return comp.compress(data) + comp.flush()
+
+
+def bgzf_block(data, level=DEFAULT_LEVEL):
+    '''
+    Compresses at most BGZF_BLOCK_SIZE bytes of data as one BGZF block
+    '''
+    deflated = _deflate(data, level)
+    size = _BGZF_HEADER.size + len(deflated) + _BGZF_FOOTER.size
+    if size > _BGZF_MAX_BLOCK:
+        # incompressible data, so just store it
+        deflated = _deflate(data, 0)
+        size = _BGZF_HEADER.size + len(deflated) + _BGZF_FOOTER.size
+
+    header = _BGZF_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, size - 1)
+    return header + deflated + _BGZF_FOOTER.pack(zlib.crc32(data) & 0xffffffff, len(data))
+
+
+def bgzf_blocks(data, level=DEFAULT_LEVEL):
+    blocks = []
+    for i in xrange(0, len(data), BGZF_BLOCK_SIZE):
+        blocks.append(bgzf_block(data[i:i + BGZF_BLOCK_SIZE], level))
+    return ''.join(blocks)
+
+
+def compress_block(data, method=None, level=DEFAULT_LEVEL):
+    '''
+    Compresses data using method ('gzip', 'bgzf' or None for no compression)
+    '''
+    if method == 'gzip':
+        return gzip_member(data, level)
+    elif method == 'bgzf':
+        return bgzf_blocks(data, level)
+    return data
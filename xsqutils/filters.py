@@ -0,0 +1,101 @@
+'''
+Per-read filters that are applied to decoded reads (see
+XSQFile.fetch_region_arrays) before they are written out.
+
+All of the filtering is done on whole arrays of reads at a time. When more
+than one tag is converted, a read is dropped if it fails the filters for
+any tag, so the tags stay in sync.
+'''
+import numpy
+
+
+class ReadFilter(object):
+    '''
+    min_mean_qual  - drop reads with a mean QV below this value
+    max_wildcards  - drop reads with more than this many wildcard calls
+    trim_qual      - trim calls with a QV below this value from the 3' end
+    min_length     - drop reads that are shorter than this after trimming
+    '''
+    def __init__(self, min_mean_qual=None, max_wildcards=None, trim_qual=None, min_length=1):
+        self.min_mean_qual = min_mean_qual
+        self.max_wildcards = max_wildcards
+        self.trim_qual = trim_qual
+        self.min_length = min_length
+
+    def untrimmed(self):
+        '''
+        Returns a copy of the filter that doesn't trim reads (so -minqv and
+        -maxwild apply to the whole read, and -minlen doesn't apply)
+        '''
+        return ReadFilter(self.min_mean_qual, self.max_wildcards, None, self.min_length)
+
+    def is_active(self):
+        return self.min_mean_qual is not None or self.max_wildcards is not None or self.trim_qual is not None
+
+    def __call__(self, values):
+        '''
+        Filters a dict of tag -> (calls, quals) (ASCII calls and Phred+33
+        qualities, as returned by decode_callqv).
+
+        Returns a tuple (keep, lengths) where keep is a boolean array with one
+        value per read, and lengths is a dict of tag -> array of trimmed read
+        lengths (or None if no trimming was done).
+        '''
+        keep = None
+        lengths = None
+        if self.trim_qual is not None:
+            lengths = {}
+
+        for tag in values:
+            calls, quals = values[tag]
+            quals = quals.astype(numpy.int32) - 33
+            n, readlen = quals.shape
+
+            if keep is None:
+                keep = numpy.ones(n, dtype=bool)
+
+            if self.trim_qual is not None:
+                # the read is kept up to (and including) the last good call
+                good = quals >= self.trim_qual
+                taglen = readlen - numpy.argmax(good[:, ::-1], axis=1)
+                taglen[~good.any(axis=1)] = 0
+                lengths[tag] = taglen
+
+                inread = numpy.arange(readlen) < taglen[:, numpy.newaxis]
+                keep &= taglen >= self.min_length
+            else:
+                taglen = numpy.empty(n, dtype=numpy.int32)
+                taglen.fill(readlen)
+                inread = numpy.ones(quals.shape, dtype=bool)
+
+            if self.min_mean_qual is not None:
+                sums = (quals * inread).sum(axis=1)
+                keep &= sums >= self.min_mean_qual * numpy.maximum(taglen, 1)
+
+            if self.max_wildcards is not None:
+                # wildcards are the only calls that decode to N (or .)
+                wildcards = ((calls == ord('N')) | (calls == ord('.'))) & inread
+                keep &= wildcards.sum(axis=1) <= self.max_wildcards
+
+        return keep, lengths
+
+    def apply(self, locations, values):
+        '''
+        Removes the reads that fail the filters from locations and values (as
+        returned by XSQFile.fetch_region_arrays).
+
+        Returns a tuple (locations, values, lengths), where lengths is as
+        returned by __call__.
+        '''
+        keep, lengths = self(values)
+        if keep is None:
+            return locations, values, lengths
+
+        filtered = {}
+        for tag in values:
+            calls, quals = values[tag]
+            filtered[tag] = (calls[keep], quals[keep])
+            if lengths is not None:
+                lengths[tag] = lengths[tag][keep]
+
+        return locations[keep], filtered, lengths
@@ -0,0 +1,224 @@
+'''
+Formats chunks of reads (see XSQFile.fetch_region_arrays) for output as
+FASTQ, unaligned BAM or raw NumPy (.npy) arrays.
+
+FASTQ and BAM records are built as rows of a byte matrix (one row per read,
+with the tags side by side). Parts of a record that vary in length (the
+digits of the region_y_x read names, trimmed calls) are masked out of the
+matrix, so a whole chunk is formatted without any per-read Python work.
+'''
+import struct
+
+import numpy
+
+FORMATS = ['fastq', 'bam', 'npy']
+
+# .npy headers are padded to a fixed size, so that the shape can be filled in
+# once the number of reads is known
+NPY_HEADER_SIZE = 128
+
+# BAM 4-bit base codes (=ACMGRSVTWYHKDBN), anything else is an N
+_BAM_BASES = numpy.empty(256, dtype=numpy.uint8)
+_BAM_BASES.fill(15)
+for _i, _base in enumerate('=ACMGRSVTWYHKDBN'):
+    _BAM_BASES[ord(_base)] = _i
+
+_BAM_FIXED = numpy.dtype([('block_size', '<i4'), ('refID', '<i4'), ('pos', '<i4'), ('l_read_name', 'u1'),
+                          ('mapq', 'u1'), ('bin', '<u2'), ('n_cigar_op', '<u2'), ('flag', '<u2'), ('l_seq', '<i4'),
+                          ('next_refID', '<i4'), ('next_pos', '<i4'), ('tlen', '<i4')])
+
+# bin for unmapped reads (reg2bin(-1, 0))
+_BAM_UNMAPPED_BIN = 4680
+
+
+def _ascii_column(text, n):
+    return numpy.tile(numpy.fromstring(text, dtype=numpy.uint8), (n, 1))
+
+
+def _digit_columns(values):
+    '''
+    Formats an array of non-negative integers as right-aligned ASCII digits.
+    Returns the (n, width) digit matrix and a mask of the significant digits
+    (leading zeros are masked out).
+    '''
+    width = len(str(values.max())) if len(values) else 1
+    powers = 10 ** numpy.arange(width - 1, -1, -1, dtype=numpy.uint64)
+    values = values.astype(numpy.uint64)[:, numpy.newaxis]
+    digits = (values // powers % 10 + ord('0')).astype(numpy.uint8)
+    return digits, (values >= powers) | (powers == 1)
+
+
+def _in_read(calls, tag, lengths):
+    if lengths is None:
+        return numpy.ones(calls.shape, dtype=bool)
+    return numpy.arange(calls.shape[1]) < lengths[tag][:, numpy.newaxis]
+
+
+class _Records(object):
+    '''
+    Builds a byte matrix of records column by column, along with the mask of
+    which bytes are actually written.
+    '''
+    def __init__(self, n):
+        self.n = n
+        self.columns = []
+        self.masks = []
+
+    def add(self, columns, mask=None):
+        self.columns.append(columns)
+        if mask is None:
+            mask = numpy.ones(columns.shape, dtype=bool)
+        self.masks.append(mask)
+
+    def text(self, text):
+        self.add(_ascii_column(text, self.n))
+
+    def tostring(self):
+        if not self.columns:
+            return ''
+        return numpy.hstack(self.columns)[numpy.hstack(self.masks)].tostring()
+
+
+def fastq_chunk(region, tags, locations, values, suffix=None, lengths=None):
+    '''
+    Formats a chunk of reads as FASTQ. tags is a list of Tag tuples and
+    values is a dict of tag -> (calls, quals).
+
+    If given, lengths is a dict of tag -> array of (trimmed) read lengths
+    and the calls past the end of each read are masked out.
+    '''
+    records = _Records(len(locations))
+    ys, ymask = _digit_columns(locations[:, 0])
+    xs, xmask = _digit_columns(locations[:, 1])
+
+    for tag in tags:
+        name_end = ''
+        if len(tags) > 1:
+            name_end = ' %s' % tag.tag
+        if suffix:
+            name_end += suffix
+
+        calls, quals = values[tag.tag]
+        inread = _in_read(calls, tag.tag, lengths)
+
+        records.text('@%s_' % int(region))
+        records.add(ys, ymask)
+        records.text('_')
+        records.add(xs, xmask)
+        records.text('%s\n%s' % (name_end, tag.prefix))
+        records.add(calls, inread)
+        records.text('\n+\n')
+        records.add(quals, inread)
+        records.text('\n')
+
+    return records.tostring()
+
+
+def bam_header():
+    '''
+    The header for an unaligned BAM file (no references)
+    '''
+    text = '@HD\tVN:1.6\tSO:unsorted\n'
+    return 'BAM\x01' + struct.pack('<i', len(text)) + text + struct.pack('<i', 0)
+
+
+def bam_chunk(region, tags, locations, values, suffix=None, lengths=None):
+    '''
+    Formats a chunk of reads as unaligned BAM records (uncompressed). If
+    there is more than one tag, the reads for each tag are written as
+    segments of one template (flags 0x40/0x80 for the first/last tag).
+
+    Base space tags are written as SEQ/QUAL. Color space tags have no SEQ,
+    and are written to the CS (with the primer base) and CQ tags instead, as
+    SOLiD BAM files are.
+    '''
+    n = len(locations)
+    records = _Records(n)
+    ys, ymask = _digit_columns(locations[:, 0])
+    xs, xmask = _digit_columns(locations[:, 1])
+
+    name_start = '%s_' % int(region)
+    name_end = '%s\x00' % (suffix or '')
+    name_len = len(name_start) + ymask.sum(axis=1) + 1 + xmask.sum(axis=1) + len(name_end)
+
+    for i, tag in enumerate(tags):
+        calls, quals = values[tag.tag]
+        inread = _in_read(calls, tag.tag, lengths)
+        if lengths is None:
+            length = numpy.empty(n, dtype=numpy.int32)
+            length.fill(calls.shape[1])
+        else:
+            length = lengths[tag.tag]
+
+        if len(tags) == 1:
+            flag = 0x4
+        else:
+            flag = 0x1 | 0x4 | 0x8
+            if i == 0:
+                flag |= 0x40
+            if i == len(tags) - 1:
+                flag |= 0x80
+
+        fixed = numpy.zeros(n, dtype=_BAM_FIXED)
+        fixed['refID'] = -1
+        fixed['pos'] = -1
+        fixed['l_read_name'] = name_len
+        fixed['bin'] = _BAM_UNMAPPED_BIN
+        fixed['flag'] = flag
+        fixed['next_refID'] = -1
+        fixed['next_pos'] = -1
+
+        if tag.is_colorspace:
+            aux_len = 3 + len(tag.prefix) + length + 1 + 3 + length + 1
+            fixed['block_size'] = _BAM_FIXED.itemsize - 4 + name_len + aux_len
+        else:
+            fixed['l_seq'] = length
+            fixed['block_size'] = _BAM_FIXED.itemsize - 4 + name_len + (length + 1) // 2 + length
+
+        records.add(fixed.view(numpy.uint8).reshape(n, _BAM_FIXED.itemsize))
+        records.text(name_start)
+        records.add(ys, ymask)
+        records.text('_')
+        records.add(xs, xmask)
+        records.text(name_end)
+
+        if tag.is_colorspace:
+            records.text('CSZ%s' % tag.prefix)
+            records.add(calls, inread)
+            records.text('\x00CQZ')
+            records.add(quals, inread)
+            records.text('\x00')
+        else:
+            codes = _BAM_BASES.take(calls) * inread
+            if codes.shape[1] % 2:
+                codes = numpy.hstack([codes, numpy.zeros((n, 1), dtype=numpy.uint8)])
+            packed = (codes[:, 0::2] << 4) | codes[:, 1::2]
+            records.add(packed, numpy.arange(packed.shape[1]) < ((length + 1) // 2)[:, numpy.newaxis])
+            records.add(quals - 33, inread)
+
+    return records.tostring()
+
+
+def npy_chunk(region, tags, locations, values):
+    '''
+    Returns a chunk of reads as a list of arrays: the (n, 3) uint32 array of
+    region, y and x for each read, followed by the raw BaseCallQV/ColorCallQV
+    array for each tag.
+    '''
+    region_locations = numpy.empty((len(locations), 3), dtype=numpy.uint32)
+    region_locations[:, 0] = int(region)
+    region_locations[:, 1:] = locations
+
+    arrays = [region_locations]
+    for tag in tags:
+        arrays.append(values[tag.tag])
+    return arrays
+
+
+def npy_header(shape, dtype):
+    '''
+    A version 1.0 .npy header, padded to NPY_HEADER_SIZE bytes
+    '''
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (numpy.dtype(dtype).str, tuple(shape))
+    header = header.ljust(NPY_HEADER_SIZE - 11) + '\n'
+    return '\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header
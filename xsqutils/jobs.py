@@ -0,0 +1,195 @@
+'''
+Conversion jobs. A RegionJob is one unit of work (the reads [start, stop) of
+one region of a sample), and carries everything that is needed to convert it
+in its ConvertOptions. Jobs are plain picklable objects, so they can be sent
+to a multiprocessing pool (or any other runner) as-is, and the worker only
+needs an open XSQFile for the job's filename.
+'''
+import threading
+
+import numpy
+
+from xsqutils import DEFAULT_CHUNK_SIZE, decode_callqv, readahead
+from xsqutils.compress import compress_block, DEFAULT_LEVEL
+from xsqutils.formats import fastq_chunk, bam_chunk, npy_chunk
+from xsqutils.stats import NoStats, now
+
+
+class ConvertOptions(object):
+    '''
+    tags        - the tags to convert (None for all of them)
+    suffix      - a suffix to add to each read name
+    fmt         - the output format ('fastq', 'bam' or 'npy')
+    compress    - compress the output with 'gzip', 'bgzf' or None
+    level       - the compression level
+    chunk_size  - the number of reads to read and convert at a time
+    read_filter - a ReadFilter, reads that fail it are dropped
+    head        - convert only the first head reads of each sample
+    fraction    - convert only a random subsample of the reads
+    seed        - the random seed for fraction
+    split       - write each tag to its own output
+    stats       - keep per-stage timing stats (see stats.ConvertStats)
+    readahead   - read ahead the data for later jobs (see RegionJob)
+    '''
+    def __init__(self, tags=None, suffix=None, fmt='fastq', compress=None, level=DEFAULT_LEVEL, chunk_size=DEFAULT_CHUNK_SIZE, read_filter=None, head=None, fraction=None, seed=0, split=False, stats=False, readahead=False):
+        if read_filter and fmt == 'npy':
+            # npy output holds whole reads, so they are filtered untrimmed
+            read_filter = read_filter.untrimmed()
+        if read_filter and not read_filter.is_active():
+            read_filter = None
+
+        self.tags = tags or None
+        self.suffix = suffix
+        self.fmt = fmt
+        self.compress = compress
+        self.level = level
+        self.chunk_size = chunk_size
+        self.read_filter = read_filter
+        self.head = head
+        self.fraction = fraction
+        self.seed = seed
+        self.split = split
+        self.stats = stats
+        self.readahead = readahead
+
+    def settings(self):
+        '''
+        A string of all of the options, to check that a conversion is
+        resumed with the same options
+        '''
+        filter_settings = None
+        if self.read_filter:
+            filter_settings = sorted(vars(self.read_filter).items())
+        return repr((self.tags, self.suffix, self.fmt, self.compress, self.level, self.chunk_size, filter_settings, self.head, self.fraction, self.seed, self.split))
+
+
+class RegionJob(object):
+    '''
+    Converts the reads [start, stop) of one region of a sample.
+
+    readahead can be set to a list of (offset, size) byte ranges of the file
+    (see XSQFile.region_extents) that a later job will read. They are read in
+    a background thread while this job is converted, so that the later job
+    finds them in the OS page cache (for network filesystems, where reads
+    are latency bound).
+    '''
+    def __init__(self, filename, sample, region, start, stop, options, readahead=None):
+        self.filename = filename
+        self.sample = sample
+        self.region = region
+        self.start = start
+        self.stop = stop
+        self.options = options
+        self.readahead = readahead
+
+    def key(self):
+        '''
+        The region and read range of the job (as recorded in checkpoint
+        manifests)
+        '''
+        return [self.region, self.start, self.stop]
+
+    def convert(self, xsq, stats=None):
+        '''
+        Converts the job's reads from xsq (an open XSQFile for filename) and
+        returns the text for them in the output format, compressed with
+        options.compress. Compressed text is returned as complete gzip members
+        (or BGZF blocks), so that the output for each job can be written one
+        after the other to make a valid gzip file without recompressing
+        anything.
+
+        The text is returned as a list with one entry per output. If split is
+        set, each tag is formatted separately (one output per tag), otherwise
+        the tags for each read are written together (one output). For the
+        'npy' format, the list holds the arrays from formats.npy_chunk
+        instead (or is empty if there were no reads).
+
+        Reads that fail the read filter are dropped before they are
+        formatted. If fraction is given, only a random subsample of the reads
+        is converted.
+
+        If stats (a stats.ConvertStats) is given, the time spent in each
+        stage is added to it.
+        '''
+        opts = self.options
+        region = self.region
+        if stats is None:
+            stats = NoStats()
+
+        if self.readahead:
+            thread = threading.Thread(target=readahead, args=(self.filename, self.readahead))
+            thread.daemon = True
+            thread.start()
+
+        tags = opts.tags
+        if not tags:
+            tags = xsq.tags.keys()
+
+        if opts.split:
+            outputs = [[xsq.tags[tag]] for tag in tags]
+        else:
+            outputs = [[xsq.tags[tag] for tag in tags]]
+        out = [[] for output_tags in outputs]
+
+        # the arrays are read raw and decoded here, so that reading and
+        # decoding can be timed separately
+        if opts.fraction is not None:
+            chunks = xsq.fetch_region_sample(self.sample, region, opts.fraction, opts.seed, tags, opts.chunk_size, self.start, self.stop, True)
+        else:
+            chunks = xsq.fetch_region_chunks(self.sample, region, tags, opts.chunk_size, self.start, self.stop, True)
+
+        raw = opts.fmt == 'npy'
+        arrays = []
+        reads = 0
+        started = now()
+        t = started
+        for locations, values in chunks:
+            reads += len(locations)
+            nbytes = sum([values[tag].nbytes for tag in tags])
+            t = stats.record('read', t, locations.nbytes + nbytes, locations.nbytes + nbytes)
+
+            lengths = None
+            if raw:
+                if opts.read_filter:
+                    # filters work on the decoded calls (the filter doesn't
+                    # trim for npy, see ConvertOptions)
+                    decoded = dict([(tag, decode_callqv(values[tag], xsq.tags[tag].is_colorspace)) for tag in tags])
+                    t = stats.record('decode', t, nbytes, nbytes * 2)
+                    keep, lengths = opts.read_filter(decoded)
+                    locations = locations[keep]
+                    values = dict([(tag, values[tag][keep]) for tag in tags])
+                    t = stats.record('filter', t, nbytes * 2)
+
+                arrays.append(npy_chunk(region, [xsq.tags[tag] for tag in tags], locations, values))
+                t = stats.record('format', t, nbytes, sum([arr.nbytes for arr in arrays[-1]]))
+                continue
+
+            values = dict([(tag, decode_callqv(values[tag], xsq.tags[tag].is_colorspace)) for tag in tags])
+            t = stats.record('decode', t, nbytes, nbytes * 2)
+
+            if opts.read_filter:
+                locations, values, lengths = opts.read_filter.apply(locations, values)
+                t = stats.record('filter', t, nbytes * 2)
+
+            for output_tags, output in zip(outputs, out):
+                if opts.fmt == 'bam':
+                    output.append(bam_chunk(region, output_tags, locations, values, opts.suffix, lengths))
+                else:
+                    output.append(fastq_chunk(region, output_tags, locations, values, opts.suffix, lengths))
+                t = stats.record('format', t, sum([values[tag.tag][0].nbytes * 2 for tag in output_tags]), len(output[-1]))
+
+        if raw:
+            blocks = []
+            if arrays:
+                blocks = [numpy.concatenate(output) for output in zip(*arrays)]
+            stats.add_region(self.filename, self.sample, region, reads, started)
+            return blocks
+
+        blocks = []
+        for output in out:
+            text = ''.join(output)
+            blocks.append(compress_block(text, opts.compress, opts.level))
+            t = stats.record('compress', t, len(text), len(blocks[-1]))
+
+        stats.add_region(self.filename, self.sample, region, reads, started)
+        return blocks
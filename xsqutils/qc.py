@@ -0,0 +1,239 @@
+'''
+Per-sample quality statistics (xsq stats).
+
+The statistics are kept as count arrays that are updated a whole chunk of
+reads at a time from the raw BaseCallQV/ColorCallQV bytes (see
+decode_callqv): a histogram of QVs for each cycle and a count of each call
+(or wildcard) for each cycle. Everything else (mean and quantile QVs,
+composition, wildcard rates) is worked out from the counts when the report
+is made. Counts from different regions (or workers) are merged by adding
+them together, so the result doesn't depend on how the reads were split up.
+'''
+import collections
+import sys
+
+import numpy
+
+from xsqutils import QV_WILDCARD, DEFAULT_CHUNK_SIZE
+
+# QVs are six bits
+QV_BINS = 64
+
+# the two call bits, plus one more for wildcards
+CALL_BINS = 5
+
+QUANTILES = [0.1, 0.25, 0.5, 0.75, 0.9]
+
+
+class TagQC(object):
+    '''
+    The counts for one tag of a sample.
+
+    quals - cycle x QV counts (wildcard calls aren't counted, as they don't
+            have a QV)
+    calls - cycle x call counts, with the calls (0-3) in the order of the
+            tag's bases (ACGT or 0123) and wildcards last
+    '''
+    def __init__(self, tag, is_colorspace=False, length=0):
+        self.tag = tag
+        self.is_colorspace = is_colorspace
+        self.quals = numpy.zeros((length, QV_BINS), dtype=numpy.int64)
+        self.calls = numpy.zeros((length, CALL_BINS), dtype=numpy.int64)
+
+    def _resize(self, length):
+        if length > len(self.quals):
+            quals = numpy.zeros((length, QV_BINS), dtype=numpy.int64)
+            quals[:len(self.quals)] = self.quals
+            calls = numpy.zeros((length, CALL_BINS), dtype=numpy.int64)
+            calls[:len(self.calls)] = self.calls
+            self.quals = quals
+            self.calls = calls
+
+    def add_chunk(self, callqv):
+        '''
+        Adds a 2-D array of BaseCallQV/ColorCallQV bytes (one row per read)
+        '''
+        callqv = numpy.asarray(callqv, dtype=numpy.uint8)
+        n, length = callqv.shape
+        if not n:
+            return
+        self._resize(length)
+
+        # each (cycle, value) pair is counted with one bincount over
+        # cycle * bins + value
+        qvs = callqv >> 2
+        wildcard = qvs == QV_WILDCARD
+
+        offsets = numpy.arange(length, dtype=numpy.intp) * QV_BINS
+        counts = numpy.bincount((qvs + offsets).ravel(), minlength=length * QV_BINS)
+        self.quals[:length] += counts.reshape(length, QV_BINS)
+        self.quals[:length, QV_WILDCARD] = 0
+
+        calls = callqv & 0x03
+        calls[wildcard] = CALL_BINS - 1
+
+        offsets = numpy.arange(length, dtype=numpy.intp) * CALL_BINS
+        counts = numpy.bincount((calls + offsets).ravel(), minlength=length * CALL_BINS)
+        self.calls[:length] += counts.reshape(length, CALL_BINS)
+
+    def add(self, other):
+        self._resize(len(other.quals))
+        self.quals[:len(other.quals)] += other.quals
+        self.calls[:len(other.calls)] += other.calls
+
+    def bases(self):
+        if self.is_colorspace:
+            return ['0', '1', '2', '3', '.']
+        return ['A', 'C', 'G', 'T', 'N']
+
+    def mean_quals(self):
+        '''
+        The mean QV of each cycle (of the calls that aren't wildcards)
+        '''
+        totals = self.quals.sum(axis=1)
+        sums = (self.quals * numpy.arange(QV_BINS)).sum(axis=1)
+        return sums / numpy.maximum(totals, 1).astype(float)
+
+    def quantile_quals(self, quantiles=QUANTILES):
+        '''
+        Returns a cycle x quantile array of the QV at each quantile (the
+        lowest QV that at least that fraction of the calls are at or below)
+        '''
+        totals = self.quals.sum(axis=1)
+        cumulative = self.quals.cumsum(axis=1)
+        out = numpy.zeros((len(self.quals), len(quantiles)), dtype=numpy.int32)
+        for i, quantile in enumerate(quantiles):
+            out[:, i] = (cumulative < (totals * quantile)[:, numpy.newaxis]).sum(axis=1)
+        out[totals == 0] = 0
+        return out
+
+    def composition(self):
+        '''
+        The fraction of each call (and of wildcards) at each cycle
+        '''
+        totals = self.calls.sum(axis=1)
+        return self.calls / numpy.maximum(totals, 1).astype(float)[:, numpy.newaxis]
+
+    def wildcard_rate(self):
+        '''
+        The fraction of all calls that are wildcards
+        '''
+        total = self.calls.sum()
+        if not total:
+            return 0.0
+        return self.calls[:, -1].sum() / float(total)
+
+    def report(self):
+        '''
+        Returns the stats as a dict (for a JSON report)
+        '''
+        bases = self.bases()
+        means = self.mean_quals()
+        composition = self.composition()
+        quantiles = self.quantile_quals()
+
+        cycles = []
+        for cycle in xrange(len(self.quals)):
+            cycles.append({'cycle': cycle + 1,
+                           'mean_qv': means[cycle],
+                           'quantiles': dict([(str(q), int(quantiles[cycle, i])) for i, q in enumerate(QUANTILES)]),
+                           'composition': dict([(base, composition[cycle, i]) for i, base in enumerate(bases)]),
+                           'qv_counts': self.quals[cycle].tolist()})
+
+        return {'colorspace': bool(self.is_colorspace), 'wildcard_rate': self.wildcard_rate(), 'cycles': cycles}
+
+
+class SampleQC(object):
+    '''
+    The stats for one sample: a TagQC for each tag and the number of reads in
+    each region.
+    '''
+    def __init__(self, sample):
+        self.sample = sample
+        self.tags = collections.OrderedDict()
+        self.regions = {}
+        self.reads = 0
+
+    def add_reads(self, region, reads):
+        self.regions[region] = self.regions.get(region, 0) + reads
+        self.reads += reads
+
+    def add(self, other):
+        for tag in other.tags:
+            if tag not in self.tags:
+                self.tags[tag] = TagQC(tag, other.tags[tag].is_colorspace)
+            self.tags[tag].add(other.tags[tag])
+
+        for region in other.regions:
+            self.add_reads(region, other.regions[region])
+
+    def region_histogram(self, bins=10):
+        '''
+        Returns a list of (low, high, regions) for a histogram of the number
+        of reads in each region, in at most bins bins. The bins are whole
+        numbers of reads wide, and low and high are both included.
+        '''
+        if not self.regions:
+            return []
+
+        counts = numpy.array(self.regions.values(), dtype=numpy.int64)
+        low = counts.min()
+        width = max(1, -(-(counts.max() - low + 1) // bins))
+        hist = numpy.bincount((counts - low) // width)
+        return [(int(low + i * width), int(low + (i + 1) * width - 1), int(n)) for i, n in enumerate(hist)]
+
+    def report(self):
+        '''
+        Returns the stats as a dict (for a JSON report)
+        '''
+        return {'reads': self.reads,
+                'regions': dict(self.regions),
+                'region_histogram': [{'low': low, 'high': high, 'regions': n} for low, high, n in self.region_histogram()],
+                'tags': dict([(tag, self.tags[tag].report()) for tag in self.tags])}
+
+    def write_report(self, out=sys.stdout):
+        out.write('Sample: %s\n' % self.sample)
+        out.write('Reads: %s in %s regions\n' % (self.reads, len(self.regions)))
+
+        for tag in self.tags:
+            tag_qc = self.tags[tag]
+            bases = tag_qc.bases()
+            means = tag_qc.mean_quals()
+            quantiles = tag_qc.quantile_quals()
+            composition = tag_qc.composition()
+
+            out.write('\n[%s] wildcard rate: %.4f\n' % (tag, tag_qc.wildcard_rate()))
+            out.write('%5s %6s %s %s\n' % ('cycle', 'mean', ' '.join(['%4s' % ('q%d' % (q * 100)) for q in QUANTILES]), ' '.join(['%6s' % ('%%%s' % base) for base in bases])))
+            for cycle in xrange(len(means)):
+                out.write('%5d %6.2f %s %s\n' % (cycle + 1, means[cycle], ' '.join(['%4d' % qv for qv in quantiles[cycle]]), ' '.join(['%6.2f' % (val * 100) for val in composition[cycle]])))
+
+        out.write('\nReads per region:\n')
+        for region in sorted(self.regions):
+            out.write('    %s %s\n' % (region, self.regions[region]))
+
+        out.write('\nRegion read count histogram:\n')
+        for low, high, n in self.region_histogram():
+            out.write('    %10d - %-10d %s\n' % (low, high, n))
+        out.write('\n')
+
+
+def region_qc(xsq, sample, region, tags=None, chunk_size=DEFAULT_CHUNK_SIZE, start=0, stop=None):
+    '''
+    Returns a SampleQC for the reads [start, stop) of one region of a sample
+    in xsq (an open XSQFile). The reads are read raw and never formatted.
+    '''
+    if not tags:
+        tags = xsq.tags.keys()
+
+    qc = SampleQC(sample)
+    for tag in tags:
+        qc.tags[tag] = TagQC(tag, xsq.tags[tag].is_colorspace)
+
+    reads = 0
+    for locations, values in xsq.fetch_region_chunks(sample, region, tags, chunk_size, start, stop, True):
+        reads += len(locations)
+        for tag in tags:
+            qc.tags[tag].add_chunk(values[tag])
+
+    qc.add_reads(region, reads)
+    return qc
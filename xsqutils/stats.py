@@ -0,0 +1,137 @@
+'''
+Per-stage timing for conversions.
+
+Each job records the wall and CPU time spent in each stage of its
+conversion (reading the HDF5 arrays, decoding, filtering, formatting and
+compressing), along with the bytes going in and out of the stage. The
+workers send their ConvertStats back to the parent with their output, where
+they are added together (along with the time spent merging the output) into
+one report for the conversion.
+'''
+import os
+import sys
+import time
+
+STAGES = ['read', 'decode', 'filter', 'format', 'compress', 'merge']
+
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def now():
+    '''
+    The current (wall, cpu) time, to pass to ConvertStats.record
+    '''
+    return (time.time(), _cpu_time())
+
+
+class NoStats(object):
+    '''
+    Stands in for ConvertStats when stats aren't being kept
+    '''
+    def record(self, stage, since, bytes_in=0, bytes_out=0):
+        return None
+
+    def add_region(self, filename, sample, region, reads, since):
+        pass
+
+
+class ConvertStats(object):
+    def __init__(self):
+        # stage -> [wall, cpu, bytes in, bytes out]
+        self.stages = {}
+        for stage in STAGES:
+            self.stages[stage] = [0.0, 0.0, 0, 0]
+
+        # (filename, sample) -> region -> [reads, wall, cpu]
+        self.regions = {}
+        self.reads = 0
+
+        # set by the parent for the whole conversion
+        self.elapsed = 0.0
+        self.procs = 1
+
+    def record(self, stage, since, bytes_in=0, bytes_out=0):
+        '''
+        Adds the time from since (a (wall, cpu) tuple from now()) to the
+        current time to stage. Returns the current time, so that the next
+        stage can be timed from it.
+        '''
+        current = now()
+        totals = self.stages[stage]
+        totals[0] += current[0] - since[0]
+        totals[1] += current[1] - since[1]
+        totals[2] += bytes_in
+        totals[3] += bytes_out
+        return current
+
+    def add_region(self, filename, sample, region, reads, since):
+        '''
+        Adds the reads converted from a region (or part of one) of a sample
+        in filename and the time taken to convert them, from since to the
+        current time.
+        '''
+        current = now()
+        regions = self.regions.setdefault((filename, sample), {})
+        totals = regions.setdefault(region, [0, 0.0, 0.0])
+        totals[0] += reads
+        totals[1] += current[0] - since[0]
+        totals[2] += current[1] - since[1]
+        self.reads += reads
+
+    def add(self, other):
+        '''
+        Adds the stats from other (from another job) to these.
+        '''
+        for stage in other.stages:
+            for i, val in enumerate(other.stages[stage]):
+                self.stages[stage][i] += val
+
+        for key in other.regions:
+            for region in other.regions[key]:
+                totals = self.regions.setdefault(key, {}).setdefault(region, [0, 0.0, 0.0])
+                for i, val in enumerate(other.regions[key][region]):
+                    totals[i] += val
+
+        self.reads += other.reads
+
+    def report(self):
+        '''
+        Returns the stats as a dict (for a JSON report). The region stats
+        are under regions/filename/sample/region.
+        '''
+        report = {'elapsed': self.elapsed, 'procs': self.procs, 'reads': self.reads, 'reads_per_sec': _rate(self.reads, self.elapsed), 'stages': {}, 'regions': {}}
+
+        for stage in STAGES:
+            wall, cpu, bytes_in, bytes_out = self.stages[stage]
+            report['stages'][stage] = {'wall': wall, 'cpu': cpu, 'bytes_in': bytes_in, 'bytes_out': bytes_out, 'reads_per_sec': _rate(self.reads, wall), 'mb_per_sec': _rate(bytes_in / 1048576.0, wall)}
+
+        for filename, sample in self.regions:
+            regions = report['regions'].setdefault(filename, {}).setdefault(sample, {})
+            for region in self.regions[(filename, sample)]:
+                reads, wall, cpu = self.regions[(filename, sample)][region]
+                regions[region] = {'reads': reads, 'wall': wall, 'cpu': cpu, 'reads_per_sec': _rate(reads, wall)}
+
+        return report
+
+    def write_summary(self, out=sys.stderr):
+        '''
+        Writes a table of the time spent in each stage. The worker stages run
+        in parallel, so their share of the elapsed time is roughly their wall
+        time divided by procs.
+        '''
+        total = sum([self.stages[stage][0] for stage in STAGES])
+
+        out.write('%-9s %10s %10s %6s %12s %12s %13s %9s\n' % ('stage', 'wall', 'cpu', '%', 'MB in', 'MB out', 'reads/sec', 'MB/sec'))
+        for stage in STAGES:
+            wall, cpu, bytes_in, bytes_out = self.stages[stage]
+            out.write('%-9s %10.2f %10.2f %6.1f %12.1f %12.1f %13.0f %9.2f\n' % (stage, wall, cpu, _rate(wall * 100, total), bytes_in / 1048576.0, bytes_out / 1048576.0, _rate(self.reads, wall), _rate(bytes_in / 1048576.0, wall)))
+        out.write('%s reads in %.2f sec (%s procs), %.0f reads/sec\n' % (self.reads, self.elapsed, self.procs, _rate(self.reads, self.elapsed)))
+
+
+def _rate(n, secs):
+    if not secs:
+        return 0
+    return n / secs
@@ -1,21 +1,46 @@
 #!/usr/bin/env python
 '''
-Converts XSQ files to FASTQ format
+Converts XSQ files to FASTQ (or unaligned BAM / NumPy) format
 '''
 
 import os
 import sys
-import gzip
+import errno
 import multiprocessing
 import shutil
+import collections
+import itertools
+import json
+import time
+import zlib
 
-from xsqutils import XSQFile
+import numpy
+
+from xsqutils import XSQFile, DEFAULT_CHUNK_SIZE, h5py, natural_sort
+from xsqutils.compress import compress_block, BGZF_EOF, DEFAULT_LEVEL
+from xsqutils.filters import ReadFilter
+from xsqutils.formats import bam_header, npy_header, FORMATS
+from xsqutils.jobs import ConvertOptions, RegionJob
+from xsqutils.qc import SampleQC, region_qc
+from xsqutils.stats import ConvertStats, now
 
 try:
     from eta import ETA
 except:
     ETA = None
 
+# AsyncResult.get() can't be interrupted with Ctrl-C unless it has a timeout
+_RESULT_TIMEOUT = 7 * 24 * 60 * 60
+
+# number of jobs per process allowed in flight (and held for reordering)
+_JOBS_PER_PROC = 4
+
+# open XSQFiles in a worker process (by filename)
+_worker_xsqs = {}
+
+# HDF5 chunk cache size to open each file with in a worker process
+_worker_cache_sizes = {}
+
 
 def pretty_number(n):
     count_l = list(str(n))
@@ -24,7 +49,44 @@ def pretty_number(n):
     return ''.join(count_l)
 
 
-def xsq_list(filename, count=False, minreads=-1, total=False):
+def _sample_read_count(args):
+    filename, sample = args
+    return _worker_xsq(filename).get_read_count(sample)
+
+
+def xsq_read_counts(filename, procs=1):
+    '''
+    Returns an OrderedDict of sample -> read count. If the counts can't be
+    read in one pass (no h5py), the samples are counted in parallel.
+    '''
+    xsq = XSQFile(filename)
+    if procs == 1 or h5py:
+        counts = xsq.get_read_counts()
+        xsq.close()
+        return counts
+
+    samples = xsq.get_samples()
+    xsq.close()
+
+    if procs < 1:
+        procs = multiprocessing.cpu_count()
+
+    pool = multiprocessing.Pool(procs, _init_worker, ([filename], ))
+    try:
+        counts = pool.map_async(_sample_read_count, [(filename, sample) for sample in samples]).get(_RESULT_TIMEOUT)
+    except KeyboardInterrupt:
+        pool.terminate()
+        sys.exit(1)
+
+    pool.close()
+    pool.join()
+    return collections.OrderedDict(zip(samples, counts))
+
+
+def xsq_list(filename, count=False, minreads=-1, total=False, procs=1):
+    if count:
+        counts = xsq_read_counts(filename, procs)
+
     xsq = XSQFile(filename)
     print 'Tags: '
     for tag in xsq.tags:
@@ -42,7 +104,7 @@ def xsq_list(filename, count=False, minreads=-1, total=False):
             desc = xsq.get_sample_desc(sample).strip()
 
             if count:
-                readcount = xsq.get_read_count(sample)
+                readcount = counts[sample]
                 if readcount > minreads:
                     pn = pretty_number(readcount)
                     if sample != 'Unclassified':
@@ -75,155 +137,842 @@ def xsq_info(filename):
     xsq.close()
 
 
-def _xsq_convert_region(filename, sample, region, tags, outname):
-    out = gzip.open(outname, 'w')
-    xsq = XSQFile(filename)
+def _init_worker(filenames, cache_sizes=None):
+    if cache_sizes:
+        _worker_cache_sizes.update(cache_sizes)
+    for filename in filenames:
+        _worker_xsq(filename)
 
-    for name, seq, quals in xsq.fetch_region(sample, region, tags):
-        if suffix:
-            out.write('@%s%s\n%s\n+\n%s\n' % (name, suffix, seq, ''.join([chr(q + 33) for q in quals])))
-        else:
-            out.write('@%s\n%s\n+\n%s\n' % (name, seq, ''.join([chr(q + 33) for q in quals])))
-    xsq.close()
-    out.close()
-    return region
 
+def _worker_xsq(filename):
+    '''
+    Returns this worker process's XSQFile for filename. Files are opened once
+    per worker and then reused for every job, so that the samples and tags
+    aren't re-read for each job.
+    '''
+    if filename not in _worker_xsqs:
+        _worker_xsqs[filename] = XSQFile(filename, _worker_cache_sizes.get(filename))
+    return _worker_xsqs[filename]
 
-def _dump_stream(src, dest, chunk_size=4 * 1024 * 1024):  # use 4MB chunk to read/write
-    while True:
-        buf = src.read(chunk_size)
-        dest.write(buf)
-        if len(buf) < chunk_size:
-            return
+
+def _xsq_convert_region(job):
+    '''
+    Converts a RegionJob in a worker process (see RegionJob.convert).
+    Returns a tuple of the output and the ConvertStats for the job (if the
+    options ask for stats, otherwise None).
+    '''
+    stats = None
+    if job.options.stats:
+        stats = ConvertStats()
+    return job.convert(_worker_xsq(job.filename), stats), stats
+
+
+def _xsq_region_qc(filename, sample, region, tags, chunk_size, start, stop):
+    '''
+    Counts the QC stats for part of a region in a worker process (see
+    qc.region_qc)
+    '''
+    return region_qc(_worker_xsq(filename), sample, region, tags, chunk_size, start, stop)
+
+
+def _ordered_results(pool, func, jobs, window):
+    '''
+    Runs func(*args) for each args in jobs on the pool and yields the results
+    in the same order as jobs. At most window jobs are in flight (running or
+    finished but waiting on an earlier job) at any one time, which bounds the
+    memory used to reorder the results.
+    '''
+    jobs = iter(jobs)
+    pending = collections.deque()
+    for args in itertools.islice(jobs, window):
+        pending.append(pool.apply_async(func, args))
+
+    while pending:
+        result = pending.popleft().get(_RESULT_TIMEOUT)
+        for args in itertools.islice(jobs, 1):
+            pending.append(pool.apply_async(func, args))
+        yield result
 
 
 class Callback(object):
+    '''
+    Shows the progress of a conversion by the number of reads converted (for
+    all of the samples together), along with the current sample and the
+    number of reads/sec so far.
+    '''
     def __init__(self, total):
-        self.i = 0
+        self.reads = 0
+        self.started = time.time()
         self.eta = ETA(total)
 
-    def __call__(self, result=None):
-        self.i += 1
-        self.eta.print_status(self.i, extra=result if result else '')
+    def __call__(self, reads, sample=None):
+        self.reads += reads
+
+        extra = ''
+        elapsed = time.time() - self.started
+        if elapsed > 0:
+            extra = '%s reads/sec' % pretty_number(int(self.reads / elapsed))
+        if sample:
+            extra = '%s %s' % (sample, extra)
+
+        self.eta.print_status(self.reads, extra=extra)
 
     def done(self):
         self.eta.done()
 
 
-#  TODO: Make this multi-process - add job queue? Or just workers?
-def xsq_convert(filename, sample=None, tags=None, suffix=None, procs=1, outname='-', tmpdir=None, noz=False):
-    sys.stderr.write("Converting: %s\n" % sample)
+class _SampleOutput(object):
+    '''
+    The output file(s) for one sample. Files are written under a temporary
+    name and only moved to their outname once all of the sample's jobs have
+    been written.
+
+    For the 'npy' format, each output is written as a .npy file with a
+    placeholder header, which is filled in with the final shape on close.
+
+    As each job is written to the temporary file(s), it is also recorded in a
+    checkpoint manifest (one JSON line per job, with the size and CRC32 of
+    each block). If the conversion is interrupted, the temporary files and
+    manifest are kept, and with resume set the next run checks the blocks
+    that were already written and only converts the jobs after them. The
+    manifest starts with the conversion settings, and is only used if these
+    match.
+    '''
+    def __init__(self, sample, outnames, jobs, options, tmpdir='.', settings='', resume=False):
+        self.sample = sample
+        self.outnames = outnames
+        self.njobs = len(jobs)
+        self.compress = options.compress
+        self.fmt = options.fmt
+        self.written = 0
+        self.npy_shapes = [None] * len(outnames)
+        self.npy_dtypes = [None] * len(outnames)
+
+        # the temporary names are made from the whole output path, so that
+        # outputs with the same file name in different directories don't
+        # share a temporary file (or manifest)
+        self.tmpnames = []
+        for outname in outnames:
+            path_crc = zlib.crc32(os.path.abspath(outname)) & 0xffffffff
+            self.tmpnames.append(os.path.join(tmpdir, '.tmp.%s.%08x' % (os.path.basename(outname), path_crc)))
+
+        self.manifest = None
+        self.manifest_name = None
+        if outnames[0] != '-':
+            self.manifest_name = '%s.manifest' % self.tmpnames[0]
+
+        self.outs = []
+        if resume and self.manifest_name and os.path.exists(self.manifest_name):
+            self.written = self._resume(jobs, settings)
+
+        if self.written:
+            sys.stderr.write('Resuming %s after %s of %s jobs\n' % (sample, self.written, self.njobs))
+            self.manifest = open(self.manifest_name, 'a')
+            return
+
+        for outname, tmpname in zip(outnames, self.tmpnames):
+            if outname == '-':
+                self.outs.append(sys.stdout)
+            else:
+                self.outs.append(open(tmpname, 'wb'))
+
+        if self.manifest_name:
+            self.manifest = open(self.manifest_name, 'w')
+            self.manifest.write('%s\n' % json.dumps({'settings': settings}))
+            self.manifest.flush()
+
+        # stdout is one stream for all of the samples, so its BAM header (and
+        # EOF block) are written by _convert_samples
+        if self.fmt == 'bam' and self.outs[0] != sys.stdout:
+            self.outs[0].write(compress_block(bam_header(), self.compress))
+        elif self.fmt == 'npy':
+            for out in self.outs:
+                out.write(npy_header((0, ), numpy.uint8))
+
+    def _resume(self, jobs, settings):
+        '''
+        Checks the blocks recorded in the manifest against the temporary
+        files, and truncates the files after the last good block. Returns the
+        number of jobs that don't need to be converted again.
+        '''
+        manifest = open(self.manifest_name)
+        try:
+            header = json.loads(manifest.readline())
+            entries = [json.loads(line) for line in manifest if line.endswith('\n')]
+        except ValueError:
+            return 0
+        finally:
+            manifest.close()
+
+        if header.get('settings') != settings:
+            sys.stderr.write('Settings changed for %s, not resuming\n' % self.sample)
+            return 0
+
+        for tmpname in self.tmpnames:
+            if not os.path.exists(tmpname):
+                return 0
+
+        self.outs = [open(tmpname, 'r+b') for tmpname in self.tmpnames]
+        offsets = [None] * len(self.outs)
+
+        done = 0
+        for job, entry in zip(jobs, entries):
+            if entry['job'] != job.key():
+                break
+
+            good = True
+            for i, out in enumerate(self.outs):
+                if offsets[i] is None:
+                    offsets[i] = entry['offsets'][i]
+                    out.seek(offsets[i])
+                if zlib.crc32(out.read(entry['sizes'][i])) & 0xffffffff != entry['crc32'][i]:
+                    good = False
+            if not good:
+                break
+
+            for i in xrange(len(self.outs)):
+                offsets[i] += entry['sizes'][i]
+                if self.fmt == 'npy' and entry['npy'][i]:
+                    rows, shape, dtype = entry['npy'][i]
+                    if self.npy_shapes[i] is None:
+                        self.npy_shapes[i] = (0, ) + tuple(shape)
+                    self.npy_shapes[i] = (self.npy_shapes[i][0] + rows, ) + self.npy_shapes[i][1:]
+                    self.npy_dtypes[i] = numpy.dtype(str(dtype))
+            done += 1
+
+        if not done:
+            for out in self.outs:
+                out.close()
+            self.outs = []
+            return 0
+
+        for out, offset in zip(self.outs, offsets):
+            out.seek(offset)
+            out.truncate()
+
+        # rewrite the manifest with just the good entries
+        manifest = open(self.manifest_name, 'w')
+        manifest.write('%s\n' % json.dumps(header))
+        for entry in entries[:done]:
+            manifest.write('%s\n' % json.dumps(entry))
+        manifest.close()
+
+        return done
+
+    def is_written(self, i):
+        '''
+        Returns True if the sample's i'th job has already been written
+        (when resuming)
+        '''
+        return i < self.written
+
+    def write(self, data, job=None):
+        '''
+        Writes the next job's output (one block of data per output file)
+        '''
+        entry = {'job': None, 'offsets': [], 'sizes': [], 'crc32': [], 'npy': []}
+
+        for i, (out, block) in enumerate(zip(self.outs, data)):
+            npy = None
+            if self.fmt == 'npy':
+                shape = self.npy_shapes[i]
+                if shape is None:
+                    shape = (0, ) + block.shape[1:]
+                self.npy_shapes[i] = (shape[0] + block.shape[0], ) + shape[1:]
+                self.npy_dtypes[i] = block.dtype
+                npy = [block.shape[0], block.shape[1:], block.dtype.str]
+                block = block.tostring()
+
+            if self.manifest:
+                entry['offsets'].append(out.tell())
+                entry['sizes'].append(len(block))
+                entry['crc32'].append(zlib.crc32(block) & 0xffffffff)
+                entry['npy'].append(npy)
+
+            out.write(block)
+            if out == sys.stdout:
+                out.flush()
+
+        if self.manifest:
+            entry['job'] = job.key()
+
+            # outputs that had no data for this job
+            for out in self.outs[len(data):]:
+                entry['offsets'].append(out.tell())
+                entry['sizes'].append(0)
+                entry['crc32'].append(0)
+                entry['npy'].append(None)
+
+            for out in self.outs:
+                out.flush()
+            self.manifest.write('%s\n' % json.dumps(entry))
+            self.manifest.flush()
+
+        self.written += 1
+        if self.written == self.njobs:
+            self.close()
+
+    def close(self):
+        for i, (out, tmpname, outname) in enumerate(zip(self.outs, self.tmpnames, self.outnames)):
+            if self.compress == 'bgzf' and out != sys.stdout:
+                out.write(BGZF_EOF)
+
+            if self.fmt == 'npy' and self.npy_shapes[i]:
+                out.seek(0)
+                out.write(npy_header(self.npy_shapes[i], self.npy_dtypes[i]))
+
+            if out != sys.stdout:
+                out.close()
+                shutil.move(tmpname, outname)
+
+        if self.manifest:
+            self.manifest.close()
+            os.unlink(self.manifest_name)
+
+    def abort(self):
+        '''
+        Closes the temporary files, keeping them (and the manifest) so that
+        the conversion can be resumed.
+        '''
+        for out in self.outs:
+            if out != sys.stdout and not out.closed:
+                out.close()
+
+        if self.manifest and not self.manifest.closed:
+            self.manifest.close()
+
+
+def _outnames(base, tags, fmt='fastq', noz=False, split=False):
+    '''
+    Returns the output file names for a sample:
+        fastq  => base.fastq.gz (or base_1.fastq.gz, base_2.fastq.gz, ... for
+                  each tag if split)
+        bam    => base.bam
+        npy    => base.locations.npy, base.F3.npy, ... for each tag
+    '''
+    if fmt == 'bam':
+        return ['%s.bam' % base]
+    elif fmt == 'npy':
+        return ['%s.locations.npy' % base] + ['%s.%s.npy' % (base, tag) for tag in tags]
+
+    if noz:
+        ext = '.fastq'
+    else:
+        ext = '.fastq.gz'
+
+    if split:
+        return ['%s_%s%s' % (base, i + 1, ext) for i in xrange(len(tags))]
+    return ['%s%s' % (base, ext)]
+
+
+def _convert_samples(samples, procs=1, tmpdir=None, resume=False):
+    '''
+    Converts a list of (filename, sample, outnames, options) tuples using
+    one pool of procs workers, where options is the ConvertOptions for the
+    sample. outnames has one name for each output of the format (see
+    _outnames).
+
+    Each region is split into chunk sized jobs so that the first reads can be
+    written (to stdout) without waiting on an entire region. The jobs for all
+    of the samples (from all of the files) are queued together (largest
+    sample first, unless they are written to stdout), so the workers don't
+    sit idle while the last regions of one sample finish. Each sample's
+    output is completed as soon as its last job has been written.
+
+    If head is given, only the first head reads of each sample are converted
+    (before any filters are applied). If fraction is given, only a random
+    subsample of the reads is converted.
+
+    If resume is set, samples with a checkpoint manifest in tmpdir (from an
+    interrupted run with the same settings) only convert their missing jobs.
+
+    If stats are set in the options, returns the ConvertStats for the
+    conversion (the workers' stats added together, with the time spent
+    writing the output as the merge stage).
+
+    The workers open each file with an HDF5 chunk cache sized to the
+    dataset chunking and chunk_size (see XSQFile.chunk_cache_size). If
+    readahead is set in the options, each job reads ahead the data for the
+    job that will be started procs jobs after it.
+    '''
     if tmpdir is None:
         tmpdir = '.'
 
     if procs < 1:
         procs = multiprocessing.cpu_count()
-    pool = multiprocessing.Pool(procs)
 
-    xsq = XSQFile(filename)
-    regions = []
-    tmpnames = []
-    for region in xsq.get_regions(sample):
-        regions.append(region)
-        tmpnames.append(os.path.join(tmpdir, '.tmp.%s.%s.%s.fastq.gz.%s' % (os.path.basename(filename), sample, region, os.getpid())))
-    xsq.close()
+    paths = [os.path.abspath(name) for sample_args in samples for name in sample_args[2] if name != '-']
+    duplicates = sorted(set([path for path in paths if paths.count(path) > 1]))
+    if duplicates:
+        sys.stderr.write('More than one sample would be written to: %s\n' % ', '.join(duplicates))
+        sys.exit(1)
+
+    filenames = []
+    xsqs = {}
+    cache_sizes = {}
+    plan = []
+    for filename, sample, outnames, options in samples:
+        if filename not in xsqs:
+            filenames.append(filename)
+            xsqs[filename] = XSQFile(filename)
+            file_samples = [sample_args[1] for sample_args in samples if sample_args[0] == filename]
+            cache_sizes[filename] = xsqs[filename].chunk_cache_size(options.chunk_size, file_samples)
+        xsq = xsqs[filename]
+
+        sample_jobs = []
+        count = 0
+        for region in xsq.get_regions(sample):
+            region_count = xsq.get_region_read_count(sample, region)
+            if options.head is not None:
+                region_count = min(region_count, options.head - count)
+            count += region_count
+            for start in xrange(0, region_count, options.chunk_size):
+                stop = min(start + options.chunk_size, region_count)
+                sample_jobs.append(RegionJob(filename, sample, region, start, stop, options))
+        plan.append((count, filename, sample, outnames, options, sample_jobs))
+
+    # samples written to stdout are kept in the order given
+    if not any(sample_plan[3][0] == '-' for sample_plan in plan):
+        plan.sort(key=lambda x: -x[0])
+
+    # the samples written to stdout (from more than one file) are written as
+    # one BAM file
+    stdout_bam = [sample_args for sample_args in samples if sample_args[2][0] == '-' and sample_args[3].fmt == 'bam']
+    if stdout_bam:
+        sys.stdout.write(compress_block(bam_header(), 'bgzf'))
+
+    jobs = []
+    outputs = []
+    for count, filename, sample, outnames, options, sample_jobs in plan:
+        settings = '%s %s' % (os.path.basename(filename), options.settings())
+        output = _SampleOutput(sample, outnames, sample_jobs, options, tmpdir, settings, resume)
+        if output.written == len(sample_jobs):
+            output.close()
+            continue
+
+        outputs.append(output)
+        for i, job in enumerate(sample_jobs):
+            if not output.is_written(i):
+                jobs.append((output, job))
+
+    for i, (output, job) in enumerate(jobs[:-procs]):
+        if job.options.readahead:
+            later = jobs[i + procs][1]
+            job.readahead = xsqs[later.filename].region_extents(later.sample, later.region, later.options.tags, later.start, later.stop)
+
+    for xsq in xsqs.values():
+        xsq.close()
 
     if ETA:
-        callback = Callback(len(regions))
+        callback = Callback(sum(queued[1].stop - queued[1].start for queued in jobs))
     else:
         callback = None
 
-    for region, tmpname in zip(regions, tmpnames):
-        pool.apply_async(_xsq_convert_region, (filename, sample, region, tags, tmpname), callback=callback)
+    stats = None
+    if any(sample_args[3].stats for sample_args in samples):
+        stats = ConvertStats()
+        stats.procs = procs
+    started = now()
 
-    pool.close()
+    # the file must be closed in the parent before the workers are started
+    pool = multiprocessing.Pool(procs, _init_worker, (filenames, cache_sizes))
+
+    # chunks are written in order as soon as they are ready. If the
+    # conversion stops early for any reason, the workers are stopped and the
+    # outputs are kept as they are (for -resume).
+    finished = False
     try:
-        pool.join()
+        for (output, job), (data, job_stats) in itertools.izip(jobs, _ordered_results(pool, _xsq_convert_region, [(queued[1], ) for queued in jobs], procs * _JOBS_PER_PROC)):
+            if stats:
+                stats.add(job_stats)
+                t = now()
+
+            output.write(data, job)
+
+            if stats:
+                if job.options.fmt == 'npy':
+                    nbytes = sum([block.nbytes for block in data])
+                else:
+                    nbytes = sum([len(block) for block in data])
+                stats.record('merge', t, nbytes, nbytes)
+
+            if callback:
+                callback(job.stop - job.start, output.sample)
+
+        if stdout_bam:
+            sys.stdout.write(BGZF_EOF)
+        sys.stdout.flush()
+        finished = True
     except KeyboardInterrupt:
-        pool.terminate()
+        sys.stderr.write('\nInterrupted. Use -resume to continue the conversion.\n')
         sys.exit(1)
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            raise
+        _broken_pipe()
+    finally:
+        if not finished:
+            pool.terminate()
+            for output in outputs:
+                output.abort()
+
+    pool.close()
+    pool.join()
 
     if callback:
         callback.done()
 
-    sys.stderr.write("Merging temp files...\n")
-    if ETA:
-        callback = Callback(len(regions))
-    else:
-        callback = None
+    if stats:
+        stats.elapsed = now()[0] - started[0]
+    return stats
 
-    tmpname = os.path.join(tmpdir, '.tmp.%s.%s.%s' % (os.path.basename(outname), sample, os.getpid()))
 
-    if outname == '-':
-        out = sys.stdout
-    elif noz:
-        out = open(tmpname, 'w')
-    else:
-        out = gzip.open(tmpname, 'w')
+def _broken_pipe():
+    '''
+    Exits after the reader of stdout has gone away (xsq convert -n S | head).
+    stdout is pointed at /dev/null first, so that the output still buffered
+    in it doesn't fail again when it is flushed on exit.
+    '''
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.close(devnull)
+    sys.exit(1)
+
+
+def _write_stats(stats, summary=False, json_fname=None):
+    '''
+    Writes the stats for a conversion as a table (to stderr) and/or as a JSON
+    report.
+    '''
+    if not stats:
+        return
 
-    for tmp in tmpnames:
-        src = gzip.open(tmp)
-        _dump_stream(src, out)
-        src.close()
-        os.unlink(tmp)
-        if callback:
-            callback()
+    if summary:
+        stats.write_summary(sys.stderr)
 
-    if out != sys.stdout:
+    if json_fname:
+        out = open(json_fname, 'w')
+        json.dump(stats.report(), out, indent=2, sort_keys=True)
+        out.write('\n')
         out.close()
-        shutil.move(tmpname, outname)
 
-    if callback:
-        callback.done()
 
+def _compression(outname, noz=False, bgzf=False, fmt='fastq'):
+    if fmt == 'bam':
+        return 'bgzf'
+    elif fmt == 'npy' or outname == '-' or noz:
+        return None
+    elif bgzf:
+        return 'bgzf'
+    return 'gzip'
 
-def xsq_convert_all(filename, tags=None, force=False, suffix=None, noz=False, usedesc=False, minreads=0, fsuffix=None, unclassified=False, procs=1, tmpdir=None):
-    xsq = XSQFile(filename)
 
-    samples = []
+def _file_prefix(filename):
+    name = os.path.basename(filename)
+    if name.lower().endswith('.xsq'):
+        name = name[:-4]
+    return name
 
-    for sample in xsq.get_samples():
-        fname = sample
-        if not fsuffix:
-            fsuffix = ''
 
-        if usedesc:
-            fname = xsq.get_sample_desc(sample)
-            if not fname:
-                fname = sample
+def _file_prefixes(filenames):
+    '''
+    Returns a dict of filename -> a prefix for its outputs that no other file
+    has: the XSQ file name (lane1), with its directory if another file has
+    the same name (d1.run), or numbered in the order given if that isn't
+    enough either (run.1, run.2).
+    '''
+    stems = collections.OrderedDict()
+    for filename in filenames:
+        files = stems.setdefault(_file_prefix(filename), [])
+        if filename not in files:
+            files.append(filename)
 
-        if fname == sample:
-            sys.stderr.write('Sample: %s... ' % fname)
+    prefixes = {}
+    for stem, files in stems.items():
+        if len(files) == 1:
+            prefixes[files[0]] = stem
+            continue
+
+        dirs = [os.path.basename(os.path.dirname(os.path.abspath(filename))) for filename in files]
+        if len(set(dirs)) == len(files):
+            for filename, dirname in zip(files, dirs):
+                prefixes[filename] = '%s.%s' % (dirname, stem)
         else:
-            sys.stderr.write('Sample: (%s) %s... ' % (sample, fname))
+            for i, filename in enumerate(files):
+                prefixes[filename] = '%s.%s' % (stem, i + 1)
+
+    return prefixes
+
 
-        if noz:
-            outname = '%s%s.fastq' % (fname, fsuffix)
+def _prefix_duplicates(names):
+    '''
+    Takes a list of (filename, name) pairs for the outputs of each sample and
+    returns the list of names to use. If the same name is used for samples
+    from more than one file, those names are prefixed with the XSQ file name
+    (lane1.Lib1_01, see _file_prefixes), so that each file's output is kept
+    separate.
+    '''
+    files = {}
+    for filename, name in names:
+        files.setdefault(name, set()).add(filename)
+
+    prefixes = _file_prefixes([filename for filename, name in names])
+
+    out = []
+    for filename, name in names:
+        if len(files[name]) > 1:
+            dirname, basename = os.path.split(name)
+            out.append(os.path.join(dirname, '%s.%s' % (prefixes[filename], basename)))
         else:
-            outname = '%s%s.fastq.gz' % (fname, fsuffix)
+            out.append(name)
+    return out
 
-        if force or not os.path.exists(outname):
-            if sample == 'Unclassified' and not unclassified:
-                sys.stderr.write(' Skipping unclassified\n')
-                continue
 
-            count = xsq.get_read_count(sample)
-            if count < minreads:
-                sys.stderr.write(' Too few reads (%s)\n' % count)
+def _filenames(filenames):
+    if isinstance(filenames, basestring):
+        return [filenames]
+    return filenames
+
+
+def xsq_convert(filenames, sample=None, tags=None, suffix=None, procs=1, outname='-', tmpdir=None, noz=False, chunk_size=DEFAULT_CHUNK_SIZE, level=DEFAULT_LEVEL, bgzf=False, read_filter=None, head=None, fraction=None, seed=0, split=False, fmt='fastq', resume=False, stats=False, stats_json=None, readahead=False):
+    '''
+    Converts one sample from one or more XSQ files. If more than one file is
+    given, the sample from each file is converted (on one pool of workers).
+    Output written to stdout is written in the order the files are given.
+    '''
+    filenames = _filenames(filenames)
+    sys.stderr.write("Converting: %s\n" % sample)
+    if fmt in ['bam', 'npy']:
+        # bam writes the tags together, npy always writes a file per tag
+        split = False
+
+    if outname == '-' and not split and fmt != 'npy':
+        outputs = ['-' for filename in filenames]
+    else:
+        if outname == '-':
+            base = sample
+        else:
+            base = outname.split('.fastq')[0]
+        outputs = _prefix_duplicates([(filename, base) for filename in filenames])
+
+    samples = []
+    for filename, base in zip(filenames, outputs):
+        xsq = XSQFile(filename)
+        if sample not in xsq.get_samples():
+            sys.stderr.write('[%s] Missing sample: %s\n' % (filename, sample))
+            xsq.close()
+            continue
+
+        file_tags = tags
+        if (split or fmt == 'npy') and not file_tags:
+            # each tag is written to its own file (sample_1.fastq.gz, ...)
+            file_tags = natural_sort(xsq.tags.keys())
+        xsq.close()
+
+        if base == '-':
+            outnames = ['-']
+        elif not split and fmt != 'npy' and len(filenames) == 1:
+            outnames = [outname]
+        else:
+            outnames = _outnames(base, file_tags, fmt, noz, split)
+
+        options = ConvertOptions(file_tags, suffix, fmt, _compression(outnames[0], noz, bgzf, fmt), level, chunk_size, read_filter, head, fraction, seed, split, stats or bool(stats_json), readahead)
+        samples.append((filename, sample, outnames, options))
+
+    if samples:
+        _write_stats(_convert_samples(samples, procs, tmpdir, resume), stats, stats_json)
+
+
+def xsq_convert_all(filenames, tags=None, force=False, suffix=None, noz=False, usedesc=False, minreads=0, fsuffix=None, unclassified=False, procs=1, tmpdir=None, chunk_size=DEFAULT_CHUNK_SIZE, level=DEFAULT_LEVEL, bgzf=False, read_filter=None, head=None, fraction=None, seed=0, split=False, fmt='fastq', resume=False, stats=False, stats_json=None, readahead=False, libraries=None):
+    '''
+    Converts all of the samples in one or more XSQ files, each to its own
+    output file(s). The samples from all of the files are converted on one
+    pool of workers.
+
+    If libraries (a list of library names or descriptions) is given, only
+    the samples that belong to those libraries are converted.
+    '''
+    filenames = _filenames(filenames)
+
+    if fmt in ['bam', 'npy']:
+        # bam writes the tags together, npy always writes a file per tag
+        split = False
+
+    if not fsuffix:
+        fsuffix = ''
+
+    # the output names for all of the files are found first, so that samples
+    # with the same name in different files can be told apart
+    # each file is only opened (and its sample index built) once
+    xsqs = dict([(filename, XSQFile(filename)) for filename in set(filenames)])
+
+    found = []
+    for filename in filenames:
+        xsq = xsqs[filename]
+        file_samples = xsq.get_samples()
+        if libraries:
+            selected = set()
+            for library in libraries:
+                selected.update(xsq.get_library_samples(library))
+            file_samples = [sample for sample in file_samples if sample in selected]
+            if not file_samples:
+                sys.stderr.write('[%s] No samples for library: %s\n' % (filename, ', '.join(libraries)))
+
+        for sample in file_samples:
+            fname = sample
+            if usedesc:
+                fname = xsq.get_sample_desc(sample)
+                if not fname:
+                    fname = sample
+            found.append((filename, sample, fname))
+
+    basenames = _prefix_duplicates([(filename, fname) for filename, sample, fname in found])
+
+    samples = []
+    for filename in filenames:
+        sys.stderr.write('[%s]\n' % filename)
+        xsq = xsqs[filename]
+
+        file_tags = tags
+        if (split or fmt == 'npy') and not file_tags:
+            file_tags = natural_sort(xsq.tags.keys())
+
+        options = ConvertOptions(file_tags, suffix, fmt, _compression(None, noz, bgzf, fmt), level, chunk_size, read_filter, head, fraction, seed, split, stats or bool(stats_json), readahead)
+
+        for (sample_filename, sample, fname), basename in zip(found, basenames):
+            if sample_filename != filename:
                 continue
 
-            samples.append((sample, outname))
-        sys.stderr.write('\n')
+            if fname == sample:
+                sys.stderr.write('Sample: %s... ' % fname)
+            else:
+                sys.stderr.write('Sample: (%s) %s... ' % (sample, fname))
+
+            outnames = _outnames('%s%s' % (basename, fsuffix), file_tags, fmt, noz, split)
+
+            missing = [outname for outname in outnames if not os.path.exists(outname)]
+            if force or missing:
+                if sample == 'Unclassified' and not unclassified and not libraries:
+                    sys.stderr.write(' Skipping unclassified\n')
+                    continue
+
+                count = xsq.get_read_count(sample)
+                if count < minreads:
+                    sys.stderr.write(' Too few reads (%s)\n' % count)
+                    continue
+
+                samples.append((filename, sample, outnames, options))
+            sys.stderr.write('\n')
+
+    for xsq in xsqs.values():
+        xsq.close()
+
+    if not samples:
+        return
+
+    sys.stderr.write("Converting: %s\n" % ', '.join([sample for filename, sample, outnames, options in samples]))
+    _write_stats(_convert_samples(samples, procs, tmpdir, resume), stats, stats_json)
 
-    xsq.close()
 
-    for sample, outname in samples:
-        xsq_convert(filename, sample, tags, suffix, procs=procs, outname=outname, noz=noz, tmpdir=tmpdir)
+def xsq_stats(filenames, samples=None, tags=None, libraries=None, procs=1, chunk_size=DEFAULT_CHUNK_SIZE, json_fname=None):
+    '''
+    Writes the QC stats (per-cycle QVs, call composition, wildcard rates
+    and reads per region, see qc.SampleQC) for each sample in one or more
+    XSQ files, or only for the given samples or libraries.
+
+    Each region is split into chunk sized jobs, which are counted on one
+    pool of procs workers (for all of the files), and the counts for each
+    sample are added together. No reads are formatted or compressed.
+    '''
+    filenames = _filenames(filenames)
+
+    if procs < 1:
+        procs = multiprocessing.cpu_count()
+
+    cache_sizes = {}
+    jobs = []
+    results = collections.OrderedDict()
+    for filename in filenames:
+        xsq = XSQFile(filename)
+
+        file_samples = xsq.get_samples()
+        if samples:
+            file_samples = [sample for sample in file_samples if sample in samples]
+        if libraries:
+            selected = set()
+            for library in libraries:
+                selected.update(xsq.get_library_samples(library))
+            file_samples = [sample for sample in file_samples if sample in selected]
+
+        cache_sizes[filename] = xsq.chunk_cache_size(chunk_size, file_samples)
+
+        file_tags = tags
+        if not file_tags:
+            file_tags = natural_sort(xsq.tags.keys())
+
+        for sample in file_samples:
+            results[(filename, sample)] = SampleQC(sample)
+            for region in xsq.get_regions(sample):
+                region_count = xsq.get_region_read_count(sample, region)
+                for start in xrange(0, region_count, chunk_size):
+                    stop = min(start + chunk_size, region_count)
+                    jobs.append((filename, sample, region, file_tags, chunk_size, start, stop))
+        xsq.close()
+
+    if ETA:
+        callback = Callback(sum([job[6] - job[5] for job in jobs]))
+    else:
+        callback = None
+
+    pool = multiprocessing.Pool(procs, _init_worker, (filenames, cache_sizes))
+    finished = False
+    try:
+        # jobs are (filename, sample, region, tags, chunk_size, start, stop)
+        for job, qc in itertools.izip(jobs, _ordered_results(pool, _xsq_region_qc, jobs, procs * _JOBS_PER_PROC)):
+            results[(job[0], job[1])].add(qc)
+            if callback:
+                callback(job[6] - job[5], job[1])
+        finished = True
+    except KeyboardInterrupt:
+        sys.exit(1)
+    finally:
+        if not finished:
+            pool.terminate()
+
+    pool.close()
+    pool.join()
+
+    if callback:
+        callback.done()
+
+    # the JSON report is written first, so that it is complete even if
+    # stdout is closed early (xsq stats -json f.json x.xsq | head)
+    if json_fname:
+        report = collections.OrderedDict()
+        for (filename, sample), qc in results.items():
+            report.setdefault(filename, collections.OrderedDict())[sample] = qc.report()
+
+        out = open(json_fname, 'w')
+        json.dump(report, out, indent=2)
+        out.write('\n')
+        out.close()
+
+    try:
+        for filename in filenames:
+            sys.stdout.write('[%s]\n' % filename)
+            for (sample_filename, sample), qc in results.items():
+                if sample_filename == filename:
+                    qc.write_report(sys.stdout)
+        sys.stdout.flush()
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            raise
+        _broken_pipe()
 
 
 def usage():
 
-    print '''Usage: xsq cmd {opts} filename.xsq
+    print '''Usage: xsq cmd {opts} filename.xsq {filename2.xsq ...}
 
 Commands:
     info      - Lists all of the data associated with the XSQ file
@@ -233,6 +982,22 @@ Commands:
           -min {val}   Hide samples that have less than {val} reads
           -total       Calculate the total number of reads
                        (Requires -c, only counts samples that meet -min)
+          -procs {val} Count the samples using {val} CPUs (if the h5py library
+                       isn't installed)
+
+    stats     - Shows QC stats for each sample: the mean and quantile QVs and
+                the call composition of each cycle, the wildcard rate and the
+                number of reads in each region
+        Options:
+          -n name        Only this sample (can be more than one)
+          -lib name      Only the samples from this library (name or
+                         description, can be more than one)
+          -t tag         Only this tag (can be more than one)
+          -procs {val}   Count the regions using {val} CPUs (default 1)
+          -chunk {val}   Read {val} reads from a region at a time
+                         (default %s)
+          -json {fname}  Also write the stats (with the QV counts for each
+                         cycle) to {fname} as JSON
 
     convert   - Converts XSQ samples and fragments to FASTQ format
         Options:
@@ -242,15 +1007,41 @@ Commands:
               -f             Overwrite existing files
               -min {val}     Skip samples that have less than {val} reads
               -noz           Don't compress the output FASTQ files with gzip
+              -bgzf          Compress the output as BGZF (indexable gzip)
               -fsuf {val}    Add suffix to file name
               -unclassified  Export "Unclassified" library (usually skipped)
 
+          -lib name      Convert all of the samples from library "name" (a
+                         library name or description, can be more than
+                         one). Takes the same options as -a.
+
           -n name        Convert only sample "name" (writes to stdout)
-                         (can be only one, written uncompressed)
+                         (can be only one, written uncompressed. If more
+                         than one file is given, the sample from each file
+                         is written in turn)
           -procs {val}   Use {val} number of threads (CPUs) to convert one
                          region at a time. (default 1)
+          -chunk {val}   Read and convert {val} reads from a region at a time
+                         (default %s)
+          -level {val}   Compression level for gzip, BGZF and BAM output (0-9,
+                         default %s)
+          -head {val}    Convert only the first {val} reads of each sample
+          -fraction {val}
+                         Convert only a random subsample of about {val}
+                         (0.0-1.0) of the reads
+          -seed {val}    Random seed for -fraction (default 0)
           -s suffix      Append a suffix to all read names
           -T dir         Use this directory for temporary files
+          -readahead     Read ahead the reads for the next regions in the
+                         background (for network filesystems, needs h5py)
+          -resume        Resume an interrupted conversion (with the same
+                         options and -T dir), keeping the regions that were
+                         already written
+          -stats         Show the time spent reading, decoding, filtering,
+                         formatting, compressing and writing the reads
+          -statsjson {fname}
+                         Write the stage timings (and per-region timings) to
+                         {fname} as JSON
           -t tag         Convert only this tag (can be more than one)
                          If more than one tag is given, the sequences for
                          each read will be written out together.
@@ -265,16 +1056,42 @@ Commands:
                            R5 qual
                            @read2
                            ...
+          -format {val}  Output format: fastq (default), bam (unaligned BAM,
+                         with multiple tags as segments of one template) or
+                         npy (NumPy .npy files of the y/x locations and raw
+                         call/QV bytes for each tag; -trim is ignored, and
+                         -minqv/-maxwild apply to the whole read)
+          -split         Write each tag to its own file instead
+                         (name_1.fastq.gz, name_2.fastq.gz, ... in the order
+                         the tags are given, or sorted by name). With -n, the
+                         files are named after the sample. Ignored for bam
+                         and npy (npy always writes a file for each tag).
+
+          Read filters (applied to each tag, reads are removed if any
+          tag fails):
+          -minqv {val}   Skip reads with a mean QV below {val}
+          -maxwild {val} Skip reads with more than {val} wildcard calls
+          -trim {val}    Trim calls with a QV below {val} from the 3' end
+          -minlen {val}  Skip reads shorter than {val} after trimming
+                         (default 1)
 
         The default is to convert all samples and all fragments/tags.
-'''
+
+        If more than one XSQ file is given, all of the files are converted
+        together, using one pool of -procs workers. If the same sample name
+        is in more than one file, its output files are prefixed with the
+        XSQ file name (lane1.Lib1_01.fastq.gz), and with the directory
+        if the files have the same name (d1.run.Lib1_01.fastq.gz).
+''' % (DEFAULT_CHUNK_SIZE, DEFAULT_CHUNK_SIZE, DEFAULT_LEVEL)
     sys.exit(1)
 
 
 if __name__ == '__main__':
     cmd = None
     sample_name = None
+    sample_names = []
     tags = []
+    libraries = []
     all = False
     fnames = []
     last = None
@@ -289,12 +1106,30 @@ if __name__ == '__main__':
     unclassified = False
     total = False
     tmpdir = None
+    chunk_size = DEFAULT_CHUNK_SIZE
+    level = DEFAULT_LEVEL
+    bgzf = False
+    read_filter = ReadFilter()
+    head = None
+    fraction = None
+    seed = 0
+    split = False
+    fmt = 'fastq'
+    resume = False
+    stats = False
+    stats_json = None
+    readahead = False
+    json_fname = None
 
     for arg in sys.argv[1:]:
-        if not cmd and arg in ['list', 'convert', 'info']:
+        if not cmd and arg in ['list', 'convert', 'info', 'stats']:
             cmd = arg
         elif last == '-n':
             sample_name = arg
+            sample_names.append(arg)
+            last = None
+        elif last == '-lib':
+            libraries.append(arg)
             last = None
         elif last == '-s':
             suffix = arg
@@ -311,15 +1146,64 @@ if __name__ == '__main__':
         elif last == '-T':
             tmpdir = arg
             last = None
+        elif last == '-chunk':
+            chunk_size = int(arg)
+            last = None
+        elif last == '-level':
+            level = int(arg)
+            if level < 0 or level > 9:
+                sys.stderr.write('Invalid compression level: %s (must be 0-9)\n\n' % arg)
+                usage()
+            last = None
+        elif last == '-minqv':
+            read_filter.min_mean_qual = int(arg)
+            last = None
+        elif last == '-maxwild':
+            read_filter.max_wildcards = int(arg)
+            last = None
+        elif last == '-trim':
+            read_filter.trim_qual = int(arg)
+            last = None
+        elif last == '-minlen':
+            read_filter.min_length = int(arg)
+            last = None
+        elif last == '-head':
+            head = int(arg)
+            last = None
+        elif last == '-fraction':
+            fraction = float(arg)
+            last = None
+        elif last == '-seed':
+            seed = int(arg)
+            last = None
+        elif last == '-format':
+            fmt = arg
+            last = None
+        elif last == '-json':
+            json_fname = arg
+            last = None
+        elif last == '-statsjson':
+            stats_json = arg
+            last = None
         elif last == '-fsuf':
             fsuf = arg
             last = None
-        elif arg in ['-t', '-n', '-s', '-min', '-fsuf', '-procs', '-T']:
+        elif arg in ['-t', '-n', '-lib', '-s', '-min', '-fsuf', '-procs', '-T', '-chunk', '-level', '-minqv', '-maxwild', '-trim', '-minlen', '-head', '-fraction', '-seed', '-format', '-statsjson', '-json']:
             last = arg
         elif arg == '-total':
             total = True
         elif arg == '-noz':
             noz = True
+        elif arg == '-bgzf':
+            bgzf = True
+        elif arg == '-split':
+            split = True
+        elif arg == '-resume':
+            resume = True
+        elif arg == '-stats':
+            stats = True
+        elif arg == '-readahead':
+            readahead = True
         elif arg == '-c':
             count = True
         elif arg == '-f':
@@ -338,20 +1222,25 @@ if __name__ == '__main__':
     if not cmd or not fnames:
         usage()
 
-    for fname in fnames:
-        sys.stderr.write('[%s]\n' % fname)
-        if cmd == 'list':
-            xsq_list(fname, count, minreads, total)
-        elif cmd == 'info':
-            xsq_info(fname)
-        elif cmd == 'convert':
-            if all:
-                xsq_convert_all(fname, tags, force, suffix, noz, usedesc, minreads, fsuf, unclassified, procs, tmpdir=tmpdir)
-            elif sample_name:
-                if len(fnames) > 1:
-                    sys.stderr.write('Too many files given! Must only convert one file at a time in this mode!\n\n')
-                    usage()
-                xsq_convert(fname, sample_name, tags, suffix, procs, tmpdir=tmpdir)
-            else:
-                sys.stderr.write('Missing argument! Must specify "-a" or "-n sample"\n\n')
-                usage()
+    if fmt not in FORMATS:
+        sys.stderr.write('Unknown output format: %s\n\n' % fmt)
+        usage()
+
+    if cmd == 'convert':
+        # all of the files are converted together on one pool of workers
+        if all or libraries:
+            xsq_convert_all(fnames, tags, force, suffix, noz, usedesc, minreads, fsuf, unclassified, procs, tmpdir=tmpdir, chunk_size=chunk_size, level=level, bgzf=bgzf, read_filter=read_filter, head=head, fraction=fraction, seed=seed, split=split, fmt=fmt, resume=resume, stats=stats, stats_json=stats_json, readahead=readahead, libraries=libraries)
+        elif sample_name:
+            xsq_convert(fnames, sample_name, tags, suffix, procs, tmpdir=tmpdir, noz=noz, chunk_size=chunk_size, level=level, bgzf=bgzf, read_filter=read_filter, head=head, fraction=fraction, seed=seed, split=split, fmt=fmt, resume=resume, stats=stats, stats_json=stats_json, readahead=readahead)
+        else:
+            sys.stderr.write('Missing argument! Must specify "-a", "-lib name" or "-n sample"\n\n')
+            usage()
+    elif cmd == 'stats':
+        xsq_stats(fnames, sample_names, tags, libraries, procs, chunk_size, json_fname)
+    else:
+        for fname in fnames:
+            sys.stderr.write('[%s]\n' % fname)
+            if cmd == 'list':
+                xsq_list(fname, count, minreads, total, procs)
+            elif cmd == 'info':
+                xsq_info(fname)